@@ -0,0 +1,244 @@
+"""Local stand-in for the Ollama HTTP API used by benchmarks.
+
+Serves /api/chat (streaming and non-streaming) and /api/embed with a configurable latency
+model: a fixed per-request overhead, a prefill rate for prompt tokens and a
+generation rate for output tokens. Embeddings are bag-of-words hashes, so
+near-identical texts get near-identical vectors. `parallel` limits how many requests are
+"on the GPU" at once, like OLLAMA_NUM_PARALLEL. GET /_stats returns request
+counters and POST /_reset clears them.
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CATEGORIES = ['Work', 'Personal', 'Finance', 'Shopping', 'Social', 'News', 'Spam']
+PRIORITIES = ['Low', 'Medium', 'High', 'Urgent']
+EMBED_DIM = 64
+FILLER = "The sender shares an update on the project and asks for a review before the deadline.".split()
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class MockOllamaServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.02, prefill_rate=2000.0,
+                 token_rate=50.0, output_tokens=60, parallel=4):
+        self.latency = latency
+        self.prefill_rate = prefill_rate
+        self.token_rate = token_rate
+        self.output_tokens = output_tokens
+        self.slots = threading.Semaphore(parallel)
+        self.lock = threading.Lock()
+        self.reset()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'by_path': {}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def respond(self, path, request):
+        """Build the response body and simulated timings for one request"""
+        messages = request.get('messages') or []
+        prompt = '\n'.join(m.get('content', '') for m in messages)
+        prompt_tokens = estimate_tokens(prompt)
+        content = self._content(prompt, request.get('format'))
+        output_tokens = estimate_tokens(content)
+
+        with self.slots:
+            prefill = prompt_tokens / self.prefill_rate
+            generate = output_tokens / self.token_rate
+            time.sleep(self.latency + prefill + generate)
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['output_tokens'] += output_tokens
+            self.stats['by_path'][path] = self.stats['by_path'].get(path, 0) + 1
+
+        ns = 1_000_000_000
+        return {
+            'model': request.get('model', 'mock'),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'message': {'role': 'assistant', 'content': content},
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((self.latency + prefill + generate) * ns),
+            'load_duration': 0,
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prefill * ns),
+            'eval_count': output_tokens,
+            'eval_duration': int(generate * ns),
+        }
+
+    def embed(self, path, request):
+        """Embedding response for a batch of inputs"""
+        inputs = request.get('input') or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        prompt_tokens = sum(estimate_tokens(text) for text in inputs)
+        with self.slots:
+            prefill = prompt_tokens / self.prefill_rate
+            time.sleep(self.latency + prefill)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['by_path'][path] = self.stats['by_path'].get(path, 0) + 1
+        ns = 1_000_000_000
+        return {
+            'model': request.get('model', 'mock'),
+            'embeddings': [self._vector(text) for text in inputs],
+            'total_duration': int((self.latency + prefill) * ns),
+            'load_duration': 0,
+            'prompt_eval_count': prompt_tokens,
+        }
+
+    def _vector(self, text):
+        vector = [0.0] * EMBED_DIM
+        for word in text.lower().split():
+            vector[hashlib.md5(word.encode('utf-8')).digest()[0] % EMBED_DIM] += 1.0
+        return vector
+
+    def _content(self, prompt, response_format):
+        digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+        if response_format or 'JSON' in prompt:
+            result = {
+                'category': CATEGORIES[digest[0] % len(CATEGORIES)],
+                'importance_score': round(digest[1] / 255, 2),
+                'requires_action': digest[2] % 3 == 0,
+                'priority_level': PRIORITIES[digest[3] % len(PRIORITIES)],
+                'suggested_action': 'Reply to the sender' if digest[2] % 3 == 0 else None,
+                'deadline': None,
+                'confidence': round(0.5 + digest[4] / 510, 2),
+            }
+            if '"summary"' in prompt:
+                result['summary'] = self._text(digest, self.output_tokens // 2)
+            return json.dumps(result)
+        return self._text(digest, self.output_tokens)
+
+    def _text(self, digest, n_tokens):
+        offset = digest[5]
+        return ' '.join(FILLER[(offset + i) % len(FILLER)] for i in range(max(1, int(n_tokens * 0.75))))
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; avoid 40ms delayed-ACK stalls
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/_stats':
+                    with server.lock:
+                        self._send_json(json.loads(json.dumps(server.stats)))
+                else:
+                    self._send_json({'status': 'ok'})
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if self.path == '/_reset':
+                    server.reset()
+                    return self._send_json({'status': 'ok'})
+                if self.path == '/api/embed':
+                    return self._send_json(server.embed(self.path, request))
+                if self.path != '/api/chat':
+                    return self._send_json({'error': f'unsupported path {self.path}'}, status=404)
+
+                response = server.respond(self.path, request)
+                if not request.get('stream', True):
+                    return self._send_json(response)
+                self._stream(response)
+
+            def _stream(self, response):
+                # NDJSON: one chunk per word, then the final done record with the stats
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                words = response['message']['content'].split(' ')
+                try:
+                    for i, word in enumerate(words):
+                        chunk = {'model': response['model'], 'created_at': response['created_at'],
+                                 'message': {'role': 'assistant',
+                                             'content': word + (' ' if i < len(words) - 1 else '')},
+                                 'done': False}
+                        self._write_chunk(json.dumps(chunk) + '\n')
+                    final = dict(response, message={'role': 'assistant', 'content': ''})
+                    self._write_chunk(json.dumps(final) + '\n')
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading early, e.g. once a JSON object closed
+                    self.close_connection = True
+
+            def _write_chunk(self, text):
+                data = text.encode('utf-8')
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--latency', type=float, default=0.02, help='fixed seconds per request')
+    parser.add_argument('--prefill-rate', type=float, default=2000.0, help='prompt tokens per second')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='output tokens per second')
+    parser.add_argument('--output-tokens', type=int, default=60)
+    parser.add_argument('--parallel', type=int, default=4, help='like OLLAMA_NUM_PARALLEL')
+    args = parser.parse_args()
+    server = MockOllamaServer(port=args.port, latency=args.latency, prefill_rate=args.prefill_rate,
+                              token_rate=args.token_rate, output_tokens=args.output_tokens,
+                              parallel=args.parallel)
+    print(f"Mock Ollama listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Throughput benchmarks for the fetch, classify, summarize and digest paths.
+
+Each (scenario, size) pair runs in a fresh process against a synthetic Gmail
+mailbox and a local mock Ollama server, so peak RSS is per scenario and no
+cache state leaks between runs. Example:
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000 --scenarios fetch classify
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_ollama import MockOllamaServer
+from synthetic_mailbox import SyntheticMailbox, FakeGmailService
+
+SCENARIOS = ('fetch', 'classify', 'classify_async', 'summarize', 'digest', 'digest_update')
+# Report runs timed by the digest_update scenario, each after one conversation changed
+DIGEST_UPDATE_ROUNDS = 20
+
+
+def _ollama_stats(url, reset=False):
+    if reset:
+        request = urllib.request.Request(f"{url}/_reset", data=b'{}', method='POST')
+        urllib.request.urlopen(request).read()
+        return None
+    with urllib.request.urlopen(f"{url}/_stats") as response:
+        return json.loads(response.read())
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def _run_scenario(scenario, size, ollama_url, concurrency, gmail_latency, with_metrics=False, fast_model=None):
+    """Run one scenario in the current (fresh) process and return its metrics"""
+    # The default ollama client reads OLLAMA_HOST at import time
+    os.environ['OLLAMA_HOST'] = ollama_url
+    workdir = tempfile.mkdtemp(prefix='mail_bench_')
+    os.chdir(workdir)
+
+    from ai_mail_agent import AIMailAgent
+    from tools.metrics import metrics
+
+    mailbox = SyntheticMailbox(size)
+    service = FakeGmailService(mailbox, latency=gmail_latency)
+    agent = AIMailAgent("bench-model", concurrency=concurrency, fast_model=fast_model)
+    agent.fetcher.service = service
+
+    latencies = []
+    extra = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scenario != 'fetch':
+            # Populate the store outside the timed section
+            emails = list(agent.fetcher.iter_emails(time_range_hours=24, use_cache=False))
+            service.http_calls = 0
+        if scenario == 'digest_update':
+            # Fixed labels stand in for classification so only digest work is timed
+            for i, email in enumerate(emails):
+                email.update(category=('Work', 'Personal', 'Finance', 'News')[i % 4], importance_score=(i % 10) / 10,
+                             requires_action=i % 7 == 0, priority_level='High' if i % 5 == 0 else 'Low',
+                             summary=f"Summary of message {i}")
+            agent.summarizer.update_digest(emails, 24)
+        _ollama_stats(ollama_url, reset=True)
+        if with_metrics:
+            metrics.reset()
+            metrics.enable()
+        started = time.perf_counter()
+
+        if scenario == 'fetch':
+            last = started
+            for _ in agent.fetcher.iter_emails(time_range_hours=24, use_cache=False):
+                now = time.perf_counter()
+                latencies.append(now - last)
+                last = now
+            extra['gmail_http_calls_per_message'] = service.http_calls / size
+
+        elif scenario == 'classify':
+            for email in emails:
+                t0 = time.perf_counter()
+                agent.classify_emails([email])
+                latencies.append(time.perf_counter() - t0)
+
+        elif scenario == 'classify_async':
+            import asyncio
+
+            async def timed(email):
+                t0 = time.perf_counter()
+                await agent.classify_emails_async([email])
+                latencies.append(time.perf_counter() - t0)
+
+            async def run_all():
+                await asyncio.gather(*(timed(email) for email in emails))
+
+            asyncio.run(run_all())
+
+        elif scenario == 'summarize':
+            for email in emails:
+                t0 = time.perf_counter()
+                email['summary'] = agent.summarizer.summarize_email(email)
+                latencies.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            agent.summarizer.summarize_time_period(emails, 24)
+            extra['period_summary_seconds'] = time.perf_counter() - t0
+
+        elif scenario == 'digest':
+            # Latency is time-to-result: when each email reached the digest file
+            with agent.summarizer.open_digest_stream(24) as writer:
+                stream = agent.iter_processed_emails(agent.fetcher.iter_emails(24, use_cache=True))
+                for email in stream:
+                    writer.add(email)
+                    latencies.append(time.perf_counter() - started)
+            extra['first_result_seconds'] = latencies[0] if latencies else 0.0
+
+        elif scenario == 'digest_update':
+            # Frequent daemon reports: one conversation changes between runs
+            for round_number in range(DIGEST_UPDATE_ROUNDS):
+                emails[round_number % len(emails)]['summary'] = f"Updated in round {round_number}"
+                t0 = time.perf_counter()
+                agent.summarizer.update_digest(emails, 24)
+                latencies.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            agent.summarizer.generate_daily_digest_markdown(emails, 24)
+            extra['full_digest_seconds'] = time.perf_counter() - t0
+
+        elapsed = time.perf_counter() - started
+
+    stats = _ollama_stats(ollama_url)
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+    if with_metrics:
+        extra['stage_report'] = metrics.report()
+
+    return dict({
+        'scenario': scenario,
+        'messages': size,
+        'seconds': elapsed,
+        'messages_per_second': size / elapsed if elapsed else 0.0,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'model_calls_per_message': stats['requests'] / size,
+        'prompt_tokens_per_message': stats['prompt_tokens'] / size,
+        'peak_rss_mb': rss_mb,
+    }, **extra)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AIMailAgent against synthetic mail and a mock Ollama")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.005, help='mock Ollama fixed seconds per request')
+    parser.add_argument('--prefill-rate', type=float, default=200000.0, help='mock prompt tokens per second')
+    parser.add_argument('--token-rate', type=float, default=20000.0, help='mock output tokens per second')
+    parser.add_argument('--parallel', type=int, default=4, help='mock OLLAMA_NUM_PARALLEL')
+    parser.add_argument('--concurrency', type=int, default=4, help='agent LLM concurrency')
+    parser.add_argument('--gmail-latency', type=float, default=0.0, help='seconds per Gmail round trip')
+    parser.add_argument('--fast-model', help='run the model cascade with this fast-tier model name')
+    parser.add_argument('--metrics', action='store_true', help='print the per-stage breakdown of each run')
+    parser.add_argument('--json', help='also write results as JSON lines to this file')
+    args = parser.parse_args()
+
+    server = MockOllamaServer(latency=args.latency, prefill_rate=args.prefill_rate,
+                              token_rate=args.token_rate, parallel=args.parallel).start()
+    results = []
+    header = f"{'scenario':<16}{'msgs':>7}{'msg/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'calls/msg':>11}{'RSS MB':>9}"
+    print(header)
+    print('-' * len(header))
+    try:
+        for size in args.sizes:
+            for scenario in args.scenarios:
+                # A fresh process per run keeps peak RSS and caches per scenario
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    result = pool.submit(_run_scenario, scenario, size, server.url,
+                                         args.concurrency, args.gmail_latency, args.metrics,
+                                         args.fast_model).result()
+                results.append(result)
+                print(f"{scenario:<16}{size:>7}{result['messages_per_second']:>10.1f}"
+                      f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                      f"{result['model_calls_per_message']:>11.2f}{result['peak_rss_mb']:>9.1f}")
+                if args.metrics:
+                    print(result['stage_report'] + '\n')
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Synthetic Gmail mailbox for benchmarks.
+
+Generates Gmail API message resources (multipart, nested parts, HTML-only,
+large bodies, bulk-mail headers) and a FakeGmailService that answers the
+subset of the discovery API that MailFetcher uses.
+"""
+import base64
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+WORDS = ("meeting project invoice deadline review update report budget team client "
+         "schedule release quarter customer order shipment account payment plan "
+         "design feedback question proposal contract renewal agenda notes").split()
+
+SENDERS = [
+    ('Alice Chen', 'alice@corp.example', []),
+    ('Bob Ortiz', 'bob@partner.example', []),
+    ('Billing', 'billing@paypal.com', []),
+    ('Shop', 'no-reply@shop.example', ['CATEGORY_PROMOTIONS']),
+    ('News Weekly', 'newsletter@news.example', ['CATEGORY_UPDATES']),
+    ('LinkedIn', 'messages-noreply@linkedin.com', ['CATEGORY_SOCIAL']),
+    ('CI', 'builds@ci.example', []),
+]
+
+SUBJECTS = [
+    'Re: {w1} {w2} for next week',
+    'Action required: {w1} {w2} by Friday',
+    'Your order has shipped',
+    'Weekly newsletter: {w1} and {w2}',
+    'Receipt for your payment',
+    '[build] {w1} pipeline failed',
+    '{w1} {w2} notes',
+]
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def _paragraphs(rng, n_words):
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return '\n\n'.join(' '.join(words[i:i + 60]) for i in range(0, len(words), 60))
+
+
+class SyntheticMailbox:
+    """Deterministic generator of Gmail-API-shaped messages"""
+
+    def __init__(self, size, seed=42, hours=24, large_body_ratio=0.05):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.hours = hours
+        self.large_body_ratio = large_body_ratio
+        self.now = datetime.now(timezone.utc)
+        self.messages = {}
+        for i in range(size):
+            message = self._make_message(i)
+            self.messages[message['id']] = message
+        self.ids = list(self.messages)
+
+    def _make_message(self, i):
+        rng = self.rng
+        name, address, labels = rng.choice(SENDERS)
+        subject = rng.choice(SUBJECTS).format(w1=rng.choice(WORDS), w2=rng.choice(WORDS))
+        date = self.now - timedelta(seconds=rng.randint(0, self.hours * 3600 - 60))
+        n_words = rng.randint(2000, 8000) if rng.random() < self.large_body_ratio else rng.randint(40, 400)
+        text = _paragraphs(rng, n_words)
+        if subject.startswith('Re:'):
+            text += '\n\nOn Mon, someone wrote:\n' + '\n'.join('> ' + line for line in _paragraphs(rng, 120).split('\n'))
+
+        headers = [
+            {'name': 'Subject', 'value': subject},
+            {'name': 'From', 'value': f'{name} <{address}>'},
+            {'name': 'Date', 'value': format_datetime(date)},
+        ]
+        if labels:
+            headers.append({'name': 'List-Unsubscribe', 'value': f'<mailto:unsubscribe@{address.split("@")[1]}>'})
+
+        return {
+            'id': f'msg{i:07d}',
+            'threadId': f'thr{i // 3:07d}',
+            'historyId': str(1000 + i),
+            'labelIds': ['INBOX'] + labels,
+            'internalDate': str(int(date.timestamp() * 1000)),
+            'payload': self._make_payload(text, headers, i),
+        }
+
+    def _make_payload(self, text, headers, i):
+        html = '<html><body>' + ''.join(f'<p>{p}</p>' for p in text.split('\n\n')) + '</body></html>'
+        kind = i % 4
+        if kind == 0:
+            # Plain single-part message
+            return {'mimeType': 'text/plain', 'headers': headers,
+                    'body': {'size': len(text), 'data': _b64(text)}}
+        alternative = {'mimeType': 'multipart/alternative', 'body': {'size': 0}, 'parts': [
+            {'mimeType': 'text/plain', 'body': {'size': len(text), 'data': _b64(text)}},
+            {'mimeType': 'text/html', 'body': {'size': len(html), 'data': _b64(html)}},
+        ]}
+        if kind == 1:
+            return dict(alternative, headers=headers)
+        if kind == 2:
+            # multipart/mixed wrapping the alternative part plus an attachment
+            return {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0}, 'parts': [
+                alternative,
+                {'mimeType': 'application/pdf', 'filename': f'report{i}.pdf',
+                 'body': {'size': 120000, 'attachmentId': f'att{i}'}},
+            ]}
+        # HTML-only newsletter
+        return {'mimeType': 'text/html', 'headers': headers,
+                'body': {'size': len(html), 'data': _b64(html)}}
+
+
+class _Request:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class _Batch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        request.in_batch = True
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service._round_trip()
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class FakeGmailService:
+    """Stand-in for build('gmail', 'v1') backed by a SyntheticMailbox
+
+    http_calls counts simulated HTTP round trips (a batch counts as one);
+    latency adds a fixed delay to each round trip.
+    """
+
+    def __init__(self, mailbox, page_size=100, latency=0.0):
+        self.mailbox = mailbox
+        self.page_size = page_size
+        self.latency = latency
+        self.http_calls = 0
+
+    def _round_trip(self):
+        self.http_calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId='me'):
+        return _Request(lambda: self._result({'historyId': str(1000 + self.mailbox.size)}))
+
+    def _result(self, value):
+        self._round_trip()
+        return value
+
+    def list(self, userId='me', q=None, pageToken=None, maxResults=100, **kwargs):
+        start = int(pageToken or 0)
+        size = min(maxResults or self.page_size, self.page_size)
+        page = self.mailbox.ids[start:start + size]
+        result = {'messages': [{'id': mid, 'threadId': self.mailbox.messages[mid]['threadId']} for mid in page],
+                  'resultSizeEstimate': len(self.mailbox.ids)}
+        if start + size < len(self.mailbox.ids):
+            result['nextPageToken'] = str(start + size)
+        return _Request(lambda: self._result(result))
+
+    def get(self, userId='me', id=None, format='full', metadataHeaders=None, messageId=None, **kwargs):
+        if messageId is not None:
+            # users().messages().attachments().get
+            return _Request(lambda: self._result({'size': 120000, 'data': _b64('%PDF-1.4 synthetic\n' * 100)}))
+        message = self.mailbox.messages[id]
+
+        def fetch():
+            if format == 'metadata':
+                wanted = {h.lower() for h in (metadataHeaders or [])}
+                headers = [h for h in message['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+                return dict(message, payload={'mimeType': message['payload']['mimeType'], 'headers': headers})
+            return message
+
+        return _MessageRequest(self, fetch)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+
+class _MessageRequest(_Request):
+    """Counts a round trip when executed directly, but not when run inside a batch"""
+
+    def __init__(self, service, fn):
+        super().__init__(fn)
+        self.service = service
+        self.in_batch = False
+
+    def execute(self):
+        if not self.in_batch:
+            self.service._round_trip()
+        return self.fn()
+
+
+class _History:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me', startHistoryId=None, **kwargs):
+        return _Request(lambda: self.service._result({'history': [], 'historyId': startHistoryId}))
@@ -1,64 +1,396 @@
-import ollama
-import json
+import argparse
+import asyncio
+import functools
+import itertools
 import os
+from datetime import datetime, timedelta
 from tools.mail_fetcher import MailFetcher
-from tools.mail_classifier import MailClassifier
+from tools.mail_classifier import MailClassifier, FALLBACK_CLASSIFICATION
+from tools.classification_cache import ClassificationCache, content_hash
 from tools.mail_summarizer import MailSummarizer
+from tools.mail_store import MailStore
+from tools.llm_engine import LLMEngine
+from tools.rule_classifier import RuleClassifier
+from tools.metrics import metrics
+from tools.threads import group_by_thread, message_timestamp, thread_key
+from tools.email_record import EmailBatch
+from tools.mail_daemon import MailDaemon
+from tools.account_runner import load_config, run_accounts
+from tools.semantic_index import SemanticIndex, DEFAULT_EMBED_MODEL
+from tools.body_text import prompt_text
+from tools.model_cascade import DEFAULT_ESCALATE_BELOW
+from tools.digest_renderer import DEFAULT_KEEP_DAYS, DIGEST_FORMATS
+
+# The detailed single-email analysis gets a larger share of the context than batch prompts
+DETAILED_BODY_TOKENS = 1000
 
 class AIMailAgent:
-    def __init__(self, model_name="deepseek-r1:8b"):
-        self.fetcher = MailFetcher()
-        self.classifier = MailClassifier(model_name)
-        self.summarizer = MailSummarizer(model_name)
+    def __init__(self, model_name="deepseek-r1:8b", db_path=None,
+                 concurrency=4, ollama_host=None, embed_model=DEFAULT_EMBED_MODEL,
+                 data_dir='.', credentials_path=None, endpoints=None, fast_model=None,
+                 escalate_below=DEFAULT_ESCALATE_BELOW, digest_formats=('md',), keep_digest_days=DEFAULT_KEEP_DAYS):
+        # Every cache, token and digest lives under data_dir, so accounts do not collide
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        db_path = db_path or os.path.join(data_dir, 'mail_store.db')
+        self.store = MailStore(db_path)
+        self.fetcher = MailFetcher(store=self.store, data_dir=data_dir, credentials_path=credentials_path)
+        # One engine shared by classifier and summarizer so the concurrency limits are global;
+        # endpoints (dicts of host, concurrency, models) replace ollama_host/concurrency
+        self.engine = LLMEngine(model_name, host=ollama_host, concurrency=concurrency, endpoints=endpoints)
+        # With fast_model, classifications and summaries try the small model first and
+        # escalate to model_name only when its answer is invalid or below escalate_below
+        self.classifier = MailClassifier(model_name, engine=self.engine, rules=RuleClassifier(),
+                                         fast_model=fast_model, escalate_below=escalate_below)
+        self.summarizer = MailSummarizer(model_name, engine=self.engine,
+                                         digest_folder=os.path.join(data_dir, 'mail_digests'),
+                                         fast_model=fast_model, escalate_below=escalate_below,
+                                         digest_formats=digest_formats, keep_digest_days=keep_digest_days)
         self.model = model_name
-        self.classified_cache_file = 'classified_emails.json'
+        self.classified_cache_file = os.path.join(data_dir, 'classified_emails.json')
+        # Process-wide stage timings and Ollama token counts; call metrics.enable() to record
+        self.metrics = metrics
+        self.classification_cache = ClassificationCache(db_path)
+        # Classify and summarize in one model call when both are needed
+        self.combined_analysis = True
+        # Analyze each conversation's new messages together with its rolling summary
+        self.thread_analysis = True
+        # Embeddings for near-duplicate clustering and semantic search
+        self.semantic = SemanticIndex(db_path, engine=self.engine, model=embed_model)
+        self.store.on_delete.append(self.semantic.forget)
+        # Classify one email per near-duplicate cluster and copy the result to the rest;
+        # turned off after the first embedding error
+        self.cluster_duplicates = True
+        # Update mail_digest.md in place instead of writing a new timestamped file per run
+        self.incremental_digest = True
+        # One-time import of the legacy JSON cache
+        self.store.migrate_json_files([self.classified_cache_file])
 
     def save_classified_emails(self, emails):
-        """Save classified emails to JSON file"""
+        """Upsert classified emails into the message store"""
         try:
-            # Convert datetime objects to string for JSON serialization
-            serializable_emails = []
-            for email_data in emails:
-                email_copy = email_data.copy()
-                if isinstance(email_copy.get('date'), str):
-                    email_copy['date'] = email_copy['date']
-                elif hasattr(email_copy.get('date'), 'isoformat'):
-                    email_copy['date'] = email_copy['date'].isoformat()
-                serializable_emails.append(email_copy)
-
-            with open(self.classified_cache_file, 'w', encoding='utf-8') as f:
-                json.dump(serializable_emails, f, indent=2, ensure_ascii=False)
-            print(f"\nSaved {len(emails)} classified emails to {self.classified_cache_file}")
+            with metrics.span('cache.save'):
+                self.store.upsert_many(emails)
+            print(f"\nSaved {len(emails)} classified emails to {self.store.db_path}")
         except Exception as e:
-            print(f"Error saving classified emails to JSON: {e}")
+            print(f"Error saving classified emails to store: {e}")
 
-    def load_classified_emails(self):
-        """Load classified emails from JSON cache"""
+    def load_classified_emails(self, hours=24):
+        """Load classified emails from the last N hours out of the message store"""
         try:
-            if os.path.exists(self.classified_cache_file):
-                with open(self.classified_cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+            emails = self.store.query(since=self._since(hours), classified=True)
+            if emails:
+                return emails
         except Exception as e:
             print(f"Error loading classified emails: {e}")
         return None
 
+    def classify_emails(self, emails, summarize=False):
+        """Classify emails in place, only calling the model for new or changed messages
+
+        Fields already present on an email are reused. With summarize=True each
+        email also gets a summary; when combined_analysis is on, emails missing
+        both get them from a single model call. With thread_analysis on, the
+        work is done per conversation instead (see classify_threads).
+        """
+        if self.thread_analysis:
+            return self.classify_threads(emails, summarize=summarize)
+        self._apply_known_classifications(emails)
+        model_calls = self._classify_clusters(emails, summarize)
+        new_results = []
+        for email in emails:
+            needs_classification, needs_summary = self._pending_work(email, summarize)
+            if needs_classification and needs_summary and self.combined_analysis:
+                model_calls += 1
+                result = self.classifier.classify_and_summarize(email)
+                self._apply_result(email, result, self.classifier.analysis_prompt_version, new_results)
+            elif needs_classification:
+                model_calls += 1
+                result = self.classifier.classify_email(email, use_rules=False)
+                self._apply_result(email, result, self.classifier.prompt_version, new_results)
+            if summarize and not email.get('summary'):
+                model_calls += 1
+                email['summary'] = self.summarizer.summarize_email(email)
+        with metrics.span('cache.save'):
+            self.classification_cache.put_many(new_results)
+        print(f"Classified {len(emails)} emails ({model_calls} model calls)")
+        if self.classifier.rules is not None:
+            print(self.classifier.rules.report())
+        return emails
+
+    async def classify_emails_async(self, emails, summarize=False):
+        """Classify (and optionally summarize) emails concurrently through the LLM engine
+
+        Each email runs its own chain of model calls, so work on early emails
+        overlaps with work on later ones.
+        """
+        if self.thread_analysis:
+            return await self.classify_threads_async(emails, summarize=summarize)
+        self._apply_known_classifications(emails)
+        await self._classify_clusters_async(emails, summarize)
+        new_results = []
+
+        async def process(email):
+            needs_classification, needs_summary = self._pending_work(email, summarize)
+            if needs_classification and needs_summary and self.combined_analysis:
+                result = await self.classifier.classify_and_summarize_async(email)
+                self._apply_result(email, result, self.classifier.analysis_prompt_version, new_results)
+            elif needs_classification:
+                result = await self.classifier.classify_email_async(email, use_rules=False)
+                self._apply_result(email, result, self.classifier.prompt_version, new_results)
+            if summarize and not email.get('summary'):
+                email['summary'] = await self.summarizer.summarize_email_async(email)
+
+        await self.engine.map(process, emails)
+        with metrics.span('cache.save'):
+            self.classification_cache.put_many(new_results)
+        print(f"Classified {len(emails)} emails ({len(new_results)} new results)")
+        if self.classifier.rules is not None:
+            print(self.classifier.rules.report())
+        return emails
+
+    def classify_threads(self, emails, summarize=False):
+        """Classify emails conversation by conversation
+
+        Cached and rule-tier results are applied per message first. The messages
+        of a thread that are new since its last analysis then go to the model in
+        one call, as new text only (quotes and signatures stripped), together
+        with the thread's stored rolling summary. Every email gets the updated
+        summary as thread_summary (and as summary when summarize=True).
+        """
+        self._apply_known_classifications(emails)
+        model_calls = self._classify_clusters(emails, summarize)
+        threads = group_by_thread(emails)
+        states = self.store.get_threads(threads)
+        updated = []
+        for key, messages in threads.items():
+            state, prompt_messages, unclassified = self._thread_work(key, messages, states.get(key))
+            summary = None
+            if unclassified:
+                model_calls += 1
+                result = self.classifier.analyze_thread(prompt_messages, state['summary'])
+                summary = self._apply_thread_result(unclassified, result)
+            elif summarize and any(not email.get('summary') for email in prompt_messages):
+                model_calls += 1
+                summary = self.summarizer.summarize_thread(prompt_messages, state['summary'])
+            if summary:
+                self._advance_thread(state, messages, summary, updated)
+            model_calls += self._finish_thread(messages, state, summarize)
+        self.store.upsert_threads(updated)
+        print(f"Classified {len(emails)} emails in {len(threads)} threads ({model_calls} model calls)")
+        if self.classifier.rules is not None:
+            print(self.classifier.rules.report())
+        return emails
+
+    async def classify_threads_async(self, emails, summarize=False):
+        """Async variant of classify_threads; threads are processed concurrently"""
+        self._apply_known_classifications(emails)
+        await self._classify_clusters_async(emails, summarize)
+        threads = group_by_thread(emails)
+        states = self.store.get_threads(threads)
+        updated = []
+
+        async def process(item):
+            key, messages = item
+            state, prompt_messages, unclassified = self._thread_work(key, messages, states.get(key))
+            summary = None
+            if unclassified:
+                result = await self.classifier.analyze_thread_async(prompt_messages, state['summary'])
+                summary = self._apply_thread_result(unclassified, result)
+            elif summarize and any(not email.get('summary') for email in prompt_messages):
+                summary = await self.summarizer.summarize_thread_async(prompt_messages, state['summary'])
+            if summary:
+                self._advance_thread(state, messages, summary, updated)
+            for email in messages:
+                if state['summary']:
+                    email['thread_summary'] = state['summary']
+                if summarize and not email.get('summary'):
+                    email['summary'] = state['summary'] or await self.summarizer.summarize_email_async(email)
+
+        await self.engine.map(process, threads.items())
+        self.store.upsert_threads(updated)
+        print(f"Classified {len(emails)} emails in {len(threads)} threads")
+        if self.classifier.rules is not None:
+            print(self.classifier.rules.report())
+        return emails
+
+    def _thread_work(self, key, messages, state):
+        """Work out which messages of a thread need the model
+
+        Returns the thread state, the messages to send (new since the last
+        analysis, or still unclassified) and the unclassified ones among them.
+        """
+        state = state or {'thread_id': key, 'subject': messages[0]['subject'], 'summary': None, 'message_ids': []}
+        seen = set(state['message_ids'])
+        unclassified = [email for email in messages if self._needs_classification(email)]
+        pending_ids = {email['message_id'] for email in unclassified}
+        prompt_messages = [email for email in messages
+                           if email['message_id'] not in seen or email['message_id'] in pending_ids]
+        return state, prompt_messages, unclassified
+
+    def _apply_thread_result(self, unclassified, result):
+        """Apply a thread classification to its unclassified messages and return the new summary"""
+        result = dict(result)
+        summary = result.pop('summary', None)
+        for email in unclassified:
+            email.update(result)
+        return summary
+
+    def _advance_thread(self, state, messages, summary, updated):
+        state['summary'] = summary
+        state['message_ids'] = list(dict.fromkeys(state['message_ids'] + [email['message_id'] for email in messages]))
+        state['last_date_ts'] = max(state.get('last_date_ts') or 0.0, message_timestamp(messages[-1]))
+        updated.append(state)
+
+    def _finish_thread(self, messages, state, summarize):
+        """Hand the thread summary to every message; returns the number of fallback model calls"""
+        calls = 0
+        for email in messages:
+            if state['summary']:
+                email['thread_summary'] = state['summary']
+            if summarize and not email.get('summary'):
+                if state['summary']:
+                    email['summary'] = state['summary']
+                else:
+                    # The thread call failed; fall back to a per-message summary
+                    calls += 1
+                    email['summary'] = self.summarizer.summarize_email(email)
+        return calls
+
+    def _duplicate_clusters(self, pending, vectors):
+        """Near-duplicate clusters of two or more emails"""
+        return [cluster for cluster in self.semantic.clusters(pending, vectors) if len(cluster) > 1]
+
+    def _cluster_candidates(self, emails):
+        """Emails that still need the model after the cache and rule tiers"""
+        if not self.cluster_duplicates:
+            return []
+        pending = [email for email in emails if self._needs_classification(email)]
+        return pending if len(pending) > 1 else []
+
+    def _classify_clusters(self, emails, summarize):
+        """Classify one leader per near-duplicate cluster and copy its result to the other members
+
+        Returns the number of model calls made. Embedding failures leave every
+        email to the regular per-message or per-thread path.
+        """
+        pending = self._cluster_candidates(emails)
+        if not pending:
+            return 0
+        try:
+            vectors = self.semantic.embed_emails(pending)
+        except Exception as e:
+            self._disable_clustering(e)
+            return 0
+        new_results = []
+        clusters = self._duplicate_clusters(pending, vectors)
+        for cluster in clusters:
+            if summarize and self.combined_analysis:
+                result = self.classifier.classify_and_summarize(cluster[0])
+                version = self.classifier.analysis_prompt_version
+            else:
+                result = self.classifier.classify_email(cluster[0], use_rules=False)
+                version = self.classifier.prompt_version
+            self._propagate(cluster, result, version, new_results)
+        with metrics.span('cache.save'):
+            self.classification_cache.put_many(new_results)
+        return len(clusters)
+
+    async def _classify_clusters_async(self, emails, summarize):
+        """Async variant of _classify_clusters; cluster leaders are classified concurrently"""
+        pending = self._cluster_candidates(emails)
+        if not pending:
+            return 0
+        try:
+            vectors = await self.semantic.embed_emails_async(pending)
+        except Exception as e:
+            self._disable_clustering(e)
+            return 0
+        new_results = []
+        combined = summarize and self.combined_analysis
+
+        async def process(cluster):
+            if combined:
+                result = await self.classifier.classify_and_summarize_async(cluster[0])
+            else:
+                result = await self.classifier.classify_email_async(cluster[0], use_rules=False)
+            version = self.classifier.analysis_prompt_version if combined else self.classifier.prompt_version
+            self._propagate(cluster, result, version, new_results)
+
+        clusters = self._duplicate_clusters(pending, vectors)
+        await self.engine.map(process, clusters)
+        with metrics.span('cache.save'):
+            self.classification_cache.put_many(new_results)
+        return len(clusters)
+
+    def _disable_clustering(self, error):
+        # Usually the embedding model is not pulled; do not pay a failing round trip on every batch
+        print(f"Embedding error, near-duplicate clustering turned off for this run: {error}")
+        self.cluster_duplicates = False
+
+    def _propagate(self, cluster, result, version, new_results):
+        leader = cluster[0]
+        self._apply_result(leader, result, version, new_results)
+        # A failed leader call would spread the fallback; leave the members to the regular path
+        if result == FALLBACK_CLASSIFICATION:
+            return
+        for member in cluster[1:]:
+            self._apply_result(member, result, version, new_results)
+            member['duplicate_of'] = leader['message_id']
+        metrics.incr('classify.cluster_propagated', len(cluster) - 1)
+
+    def _apply_known_classifications(self, emails):
+        """Merge cached, then rule-tier results into emails that have no classification yet
+
+        Combined-prompt results are a superset of plain classifications, so
+        both are looked up and the combined one wins. The rule tier runs here
+        once per email; later steps only check what is still unclassified.
+        """
+        pending = [email for email in emails if self._needs_classification(email)]
+        cached = {}
+        with metrics.span('cache.load'):
+            for version in (self.classifier.prompt_version, self.classifier.analysis_prompt_version):
+                cached.update(self.classification_cache.get_many(
+                    (email['message_id'], content_hash(email, self.classifier.model, version)) for email in pending))
+        metrics.incr('classify.cache_hits', len(cached))
+        metrics.incr('classify.cache_misses', len(pending) - len(cached))
+        for email in pending:
+            result = cached.get(email['message_id']) or self.classifier.pre_classify(email)
+            if result is not None:
+                email.update(result)
+
+    def _needs_classification(self, email):
+        # A stored fallback result means the earlier model call failed; retry it
+        return email.get('category') in (None, FALLBACK_CLASSIFICATION['category'])
+
+    def _pending_work(self, email, summarize):
+        """Which model calls remain for an email once known classifications are applied"""
+        return self._needs_classification(email), summarize and not email.get('summary')
+
+    def _apply_result(self, email, result, version, new_results):
+        email.update(result)
+        # Never cache the fallback result of a failed call
+        if result != FALLBACK_CLASSIFICATION:
+            key = content_hash(email, self.classifier.model, version)
+            new_results.append((email['message_id'], key, result))
+
+    async def _get_emails_async(self, hours, use_cache):
+        # The Gmail client is blocking; keep it off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.fetcher.get_emails, time_range_hours=hours, use_cache=use_cache))
+
+    def _since(self, hours):
+        return datetime.now() - timedelta(hours=hours)
+
     def process_recent_emails(self, hours=24, use_cache=True):
         """Process and summarize recent emails"""
         print(f"\nFetching emails from the last {hours} hours...")
         emails = self.fetcher.get_emails(time_range_hours=hours, use_cache=use_cache)
         
-        # Try to load classified emails from cache
-        classified_emails = self.load_classified_emails() if use_cache else None
-        
-        if not classified_emails:
-            print(f"\nClassifying {len(emails)} emails...")
-            for email in emails:
-                classification = self.classifier.classify_email(email)
-                email.update(classification)
-            self.save_classified_emails(emails)
-        else:
-            print("\nUsing cached classifications...")
-            emails = classified_emails
+        print(f"\nClassifying {len(emails)} emails...")
+        self.classify_emails(emails)
+        self.save_classified_emails(emails)
         
         print("\nGenerating summary...")
         summary = self.summarizer.summarize_time_period(emails, hours)
@@ -69,36 +401,56 @@ class AIMailAgent:
         """Get important emails that need attention"""
         print(f"\nChecking for important emails in the last {hours} hours...")
         
-        # Try to load classified emails from cache first
-        classified_emails = self.load_classified_emails() if use_cache else None
-        
-        if not classified_emails:
-            emails = self.fetcher.get_emails(time_range_hours=hours, use_cache=use_cache)
-            classified_emails = []
-            for email in emails:
-                classification = self.classifier.classify_email(email)
-                email.update(classification)
-                classified_emails.append(email)
-            self.save_classified_emails(classified_emails)
+        emails = self.fetcher.get_emails(time_range_hours=hours, use_cache=use_cache)
+        self.classify_emails(emails)
+        self.save_classified_emails(emails)
         
-        # Filter important emails
-        important_emails = []
-        for email in classified_emails:
-            if email.get('importance_score', 0) > 0.7 or email.get('requires_action', False):
-                if not email.get('summary'):
-                    email['summary'] = self.summarizer.summarize_email(email)
-                important_emails.append(email)
+        # Importance filtering runs as an indexed query instead of a scan over every email
+        with metrics.span('cache.load'):
+            important_emails = self.store.query(since=self._since(hours), important=True)
+        for email in important_emails:
+            if not email.get('summary'):
+                email['summary'] = self.summarizer.summarize_email(email)
+                self.store.upsert(email)
         
         return important_emails
 
-    def analyze_email(self, email_data):
-        """Analyze a single email in detail"""
-        prompt = f"""
+    def index_emails(self, hours=None):
+        """Embed stored emails (all, or the last N hours) that are not in the semantic index yet"""
+        since = self._since(hours) if hours else None
+        missing = [mid for mid in self.store.message_ids(since=since) if mid not in self.semantic.index]
+        for start in range(0, len(missing), 500):
+            self.semantic.embed_emails(self.store.get_many(missing[start:start + 500]))
+        return len(missing)
+
+    def search_emails(self, query, k=10, hours=None):
+        """Semantic search over stored mail; no generation call is made
+
+        Returns up to k emails, best match first, each with a similarity score.
+        """
+        self.index_emails(hours)
+        allowed = set(self.store.message_ids(since=self._since(hours))) if hours else None
+        while True:
+            hits = self.semantic.search(query, k=k, allowed=allowed)
+            emails = self.store.get_many([mid for mid, _ in hits])
+            # Vectors of messages deleted before deletions reached the index; drop them and search again
+            stale = {mid for mid, _ in hits} - {email['message_id'] for email in emails}
+            if not stale:
+                break
+            self.semantic.forget(stale)
+        scores = dict(hits)
+        for email in emails:
+            email['score'] = scores[email['message_id']]
+        return emails
+
+    def build_analysis_prompt(self, email_data):
+        """Build the detailed analysis prompt for an email"""
+        return f"""
         Provide a detailed analysis of this email:
 
         Subject: {email_data['subject']}
         From: {email_data['sender']}
-        Content: {email_data['body'][:2000]}
+        Content: {prompt_text(email_data, DETAILED_BODY_TOKENS)}
 
         Please analyze and provide:
         1. Key points and main message
@@ -109,11 +461,10 @@ class AIMailAgent:
         6. Priority level and urgency
         """
 
+    def analyze_email(self, email_data):
+        """Analyze a single email in detail"""
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
+            response = self.engine.chat_sync(self.build_analysis_prompt(email_data), model=self.model, stage='analyze_detail')
             return response['message']['content'].strip()
         except Exception as e:
             print(f"Analysis error: {e}")
@@ -123,54 +474,231 @@ class AIMailAgent:
         """Generate a daily digest markdown file of all emails"""
         print(f"\nGenerating daily digest for the last {hours} hours...")
         
-        # Try to load classified emails from cache first
-        classified_emails = self.load_classified_emails() if use_cache else None
-        
-        if not classified_emails:
-            emails = self.fetcher.get_emails(time_range_hours=hours, use_cache=use_cache)
-            classified_emails = []
-            print(f"\nClassifying {len(emails)} emails...")
-            for email in emails:
-                classification = self.classifier.classify_email(email)
-                email.update(classification)
-                if not email.get('summary'):
-                    email['summary'] = self.summarizer.summarize_email(email)
-                classified_emails.append(email)
-            self.save_classified_emails(classified_emails)
+        classified_emails = self.fetcher.get_emails(time_range_hours=hours, use_cache=use_cache)
+        print(f"\nClassifying {len(classified_emails)} emails...")
+        self.classify_emails(classified_emails, summarize=True)
+        self.save_classified_emails(classified_emails)
         
         # Generate and save markdown digest
         print("\nGenerating markdown digest...")
-        digest = self.summarizer.generate_daily_digest_markdown(classified_emails, hours)
+        digest = self.write_digest(classified_emails, hours)
         return digest
 
-def main():
-    agent = AIMailAgent("deepseek-r1:8b")
-    
-    # Generate daily digest
-    print("\nGenerating daily email digest...")
-    digest = agent.generate_daily_digest(hours=24, use_cache=True)
+    def write_digest(self, emails, hours=24):
+        """Update the stable digest, or write a timestamped one when incremental_digest is off"""
+        if self.incremental_digest:
+            return self.summarizer.update_digest(emails, hours)
+        return self.summarizer.generate_daily_digest_markdown(emails, hours)
+
+    def iter_processed_emails(self, emails, summarize=True, batch_size=20):
+        """Classify (and summarize) a stream of emails in small batches, yielding each when done
+
+        The stream is read through first, keeping only each conversation's
+        message IDs (the emails themselves go to the store). Batches then hold
+        whole conversations, so a thread's rolling summary is built from all
+        its messages, oldest first, before anything is yielded for it. Emails
+        come out newest conversation first, newest message first, as
+        DigestWriter expects. Only one batch is held in memory at a time;
+        results are stored per batch.
+        """
+        threads = {}
+        stream = iter(emails)
+        while True:
+            chunk = list(itertools.islice(stream, 500))
+            if not chunk:
+                break
+            self._ensure_stored(chunk)
+            for email in chunk:
+                threads.setdefault(thread_key(email), []).append((message_timestamp(email), email['message_id']))
+        batch = []
+        for messages in sorted(threads.values(), key=lambda messages: -max(messages)[0]):
+            batch.extend(message_id for _, message_id in sorted(messages, reverse=True))
+            if len(batch) >= batch_size:
+                yield from self._process_batch(self.store.get_many(batch), summarize)
+                batch = []
+        if batch:
+            yield from self._process_batch(self.store.get_many(batch), summarize)
+
+    def _ensure_stored(self, emails):
+        known = self.store.existing_ids(email['message_id'] for email in emails)
+        missing = [email for email in emails if email['message_id'] not in known]
+        if missing:
+            self.store.upsert_many(missing)
+
+    def _process_batch(self, batch, summarize):
+        self.classify_emails(batch, summarize=summarize)
+        with metrics.span('cache.save'):
+            self.store.upsert_many(batch)
+        return batch
+
+    def stream_daily_digest(self, hours=24, use_cache=True):
+        """Generate the daily digest as a fetch -> classify -> write pipeline
+
+        Peak memory does not grow with the mailbox size (beyond one ID per
+        message), and entries reach the digest file as soon as their batch is
+        processed. Returns the file path.
+        """
+        print(f"\nStreaming daily digest for the last {hours} hours...")
+        emails = self.fetcher.iter_emails(time_range_hours=hours, use_cache=use_cache)
+        with self.summarizer.open_digest_stream(hours) as writer:
+            for email in self.iter_processed_emails(emails, summarize=True):
+                writer.add(email)
+        return writer.path
+
+    async def process_recent_emails_async(self, hours=24, use_cache=True):
+        """Async variant of process_recent_emails"""
+        print(f"\nFetching emails from the last {hours} hours...")
+        emails = await self._get_emails_async(hours, use_cache)
+
+        print(f"\nClassifying {len(emails)} emails...")
+        await self.classify_emails_async(emails)
+        self.save_classified_emails(emails)
+
+        print("\nGenerating summary...")
+        return await self.summarizer.summarize_time_period_async(emails, hours)
+
+    async def get_important_emails_async(self, hours=24, use_cache=True):
+        """Async variant of get_important_emails"""
+        print(f"\nChecking for important emails in the last {hours} hours...")
+        emails = await self._get_emails_async(hours, use_cache)
+        await self.classify_emails_async(emails)
+        self.save_classified_emails(emails)
+
+        with metrics.span('cache.load'):
+            important_emails = self.store.query(since=self._since(hours), important=True)
+        missing = [email for email in important_emails if not email.get('summary')]
+        summaries = await self.engine.map(self.summarizer.summarize_email_async, missing)
+        for email, summary in zip(missing, summaries):
+            email['summary'] = summary
+        self.store.upsert_many(missing)
+
+        return important_emails
+
+    async def analyze_email_async(self, email_data):
+        """Async variant of analyze_email"""
+        try:
+            return await self.engine.chat_text(self.build_analysis_prompt(email_data), model=self.model,
+                                               stage='analyze_detail')
+        except Exception as e:
+            print(f"Analysis error: {e}")
+            return f"Error analyzing email: {email_data['subject']}"
+
+    async def generate_daily_digest_async(self, hours=24, use_cache=True):
+        """Async variant of generate_daily_digest"""
+        print(f"\nGenerating daily digest for the last {hours} hours...")
+        classified_emails = await self._get_emails_async(hours, use_cache)
+        print(f"\nClassifying {len(classified_emails)} emails...")
+        await self.classify_emails_async(classified_emails, summarize=True)
+        self.save_classified_emails(classified_emails)
+
+        print("\nGenerating markdown digest...")
+        return self.write_digest(classified_emails, hours)
+
+    async def generate_reports_async(self, hours=24, emails=None):
+        """Build the digest, important-email list and period summary from one set of emails
+
+        Emails default to the classified ones stored for the window. Summaries
+        produced during classification are shared by all three outputs.
+        """
+        if emails is None:
+            with metrics.span('cache.load'):
+                emails = self.store.query(since=self._since(hours), classified=True)
+        batch = EmailBatch(emails)
+        important_emails = batch.take(batch.important())
+        missing = [email for email in important_emails if not email.get('summary')]
+        summaries = await self.engine.map(self.summarizer.summarize_email_async, missing)
+        for email, summary in zip(missing, summaries):
+            email['summary'] = summary
+        self.store.upsert_many(missing)
+
+        print("\nGenerating markdown digest...")
+        digest = self.write_digest(emails, hours)
+        print("\nGenerating summary...")
+        summary = await self.summarizer.summarize_time_period_async(emails, hours)
+        return {'digest': digest, 'important': important_emails, 'summary': summary}
+
+    async def run_once_async(self, hours=24, use_cache=True):
+        """Fetch and classify the window once, then build every report from the same emails"""
+        print(f"\nFetching emails from the last {hours} hours...")
+        emails = await self._get_emails_async(hours, use_cache)
+        print(f"\nClassifying {len(emails)} emails...")
+        await self.classify_emails_async(emails, summarize=True)
+        self.save_classified_emails(emails)
+        return await self.generate_reports_async(hours, emails)
+
+def print_reports(reports):
     print("\nDaily Digest Generated!")
-    
-    # Process recent emails
-    print("\nProcessing recent emails...")
-    summary = agent.process_recent_emails(hours=24, use_cache=True)
     print("\nEmail Summary:")
-    print(summary)
-    
-    # Get important emails
-    print("\nFetching important emails...")
-    important = agent.get_important_emails(hours=24, use_cache=True)
+    print(reports['summary'])
     print("\nImportant Emails:")
-    for email in important:
+    for email in reports['important']:
         print(f"\nSubject: {email['subject']}")
         print(f"From: {email['sender']}")
-        print(f"Summary: {email['summary']}")
-        print(f"Action Required: {email['requires_action']}")
-        print(f"Priority Level: {email['priority_level']}")
+        print(f"Summary: {email.get('summary', 'No summary available')}")
+        print(f"Action Required: {email.get('requires_action', False)}")
+        print(f"Priority Level: {email.get('priority_level', 'Not specified')}")
         print(f"Category: {email['category']}")
         if email.get('deadline'):
             print(f"Deadline: {email['deadline']}")
         print("-" * 50)
 
+def parse_endpoint(value):
+    """HOST[=CONCURRENCY] from the command line as an LLMEngine endpoint config"""
+    host, _, concurrency = value.partition('=')
+    return {'host': host, 'concurrency': int(concurrency) if concurrency else 4}
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify and summarize recent Gmail messages")
+    parser.add_argument('--model', default="deepseek-r1:8b")
+    parser.add_argument('--fast-model', default=None,
+                        help="small model tried first; only doubtful answers go to --model")
+    parser.add_argument('--escalate-below', type=float, default=DEFAULT_ESCALATE_BELOW,
+                        help="fast-model confidence below which the answer is escalated")
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="parallel model calls; should match OLLAMA_NUM_PARALLEL")
+    parser.add_argument('--endpoint', action='append', type=parse_endpoint, metavar='HOST[=CONCURRENCY]',
+                        help="Ollama server to use; repeat to spread requests over several servers")
+    parser.add_argument('--data-dir', default='.', help="directory for the store, token and digests")
+    parser.add_argument('--accounts', help="JSON file of accounts to process in parallel worker processes")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes for --accounts")
+    parser.add_argument('--daemon', action='store_true', help="keep running and poll for new mail")
+    parser.add_argument('--interval', type=float, default=300, help="seconds between polls in daemon mode")
+    parser.add_argument('--workers', type=int, default=None, help="queue workers in daemon mode")
+    parser.add_argument('--max-queue', type=int, default=200,
+                        help="pending threads before polling waits for the workers")
+    parser.add_argument('--report-interval', type=float, default=3600,
+                        help="minimum seconds between reports in daemon mode")
+    parser.add_argument('--digest-format', action='append', choices=DIGEST_FORMATS, default=[],
+                        help="also write the digest in this format (markdown is always written); repeatable")
+    parser.add_argument('--keep-digest-days', type=int, default=DEFAULT_KEEP_DAYS,
+                        help="days of archived digests to keep")
+    args = parser.parse_args()
+
+    if args.accounts:
+        accounts, endpoints = load_config(args.accounts)
+        for result in run_accounts(accounts, endpoints=args.endpoint or endpoints, processes=args.processes):
+            print(f"\n=== {result['account']} ===")
+            if result['ok']:
+                print_reports(result)
+            else:
+                print(f"Error: {result['error']}")
+        return
+
+    agent = AIMailAgent(args.model, concurrency=args.concurrency, data_dir=args.data_dir, endpoints=args.endpoint,
+                        fast_model=args.fast_model, escalate_below=args.escalate_below,
+                        digest_formats=args.digest_format, keep_digest_days=args.keep_digest_days)
+    if args.daemon:
+        daemon = MailDaemon(agent, hours=args.hours, poll_interval=args.interval, workers=args.workers,
+                            max_queue=args.max_queue, report_interval=args.report_interval,
+                            on_report=print_reports)
+        asyncio.run(daemon.run())
+    else:
+        print_reports(asyncio.run(agent.run_once_async(hours=args.hours, use_cache=True)))
+
+    if agent.metrics.enabled:
+        print("\nStage metrics:")
+        print(agent.metrics.report())
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Tuple
+from tools.model_cascade import DEFAULT_ESCALATE_BELOW
+from tools.digest_renderer import DEFAULT_KEEP_DAYS
+
+DEFAULT_ENDPOINTS = [{'host': None, 'concurrency': 4}]
+
+
+def load_config(path: str) -> Tuple[List[Dict], Optional[List[Dict]]]:
+    """Read accounts (and optionally endpoints) from a JSON file
+
+    The file is either a list of account configs or an object with
+    "accounts" and "endpoints" keys. An account config has a "name" and may
+    set "data_dir", "model", "fast_model", "escalate_below", "hours",
+    "credentials_path", "use_cache", "digest_formats" and "keep_digest_days";
+    an endpoint has a "host" and may set "concurrency" and "models".
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if isinstance(config, list):
+        return config, None
+    return config['accounts'], config.get('endpoints')
+
+
+def share_endpoints(endpoints: List[Dict], processes: int) -> List[List[Dict]]:
+    """Split every endpoint's concurrency slots across worker processes, one endpoint list per process
+
+    Slots are dealt round-robin over all endpoints, so together the processes
+    never exceed any server's OLLAMA_NUM_PARALLEL, and every process gets at
+    least one slot when there are at least as many slots as processes. A
+    process only lists the endpoints it has slots on.
+    """
+    shares = [[] for _ in range(processes)]
+    dealt = 0
+    for endpoint in endpoints:
+        counts = [0] * processes
+        for _ in range(endpoint.get('concurrency', 4)):
+            counts[dealt % processes] += 1
+            dealt += 1
+        for share, count in zip(shares, counts):
+            if count:
+                share.append(dict(endpoint, concurrency=count))
+    return shares
+
+
+# This worker process's share of the endpoints, set by _init_worker
+_worker_endpoints: Optional[List[Dict]] = None
+
+
+def _init_worker(shares: List[List[Dict]], counter):
+    """Give each pool process its own endpoint share, in start order"""
+    global _worker_endpoints
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    _worker_endpoints = shares[index]
+
+
+def run_account(account: Dict, endpoints: Optional[List[Dict]] = None) -> Dict:
+    """Fetch, classify and report one mailbox; runs inside a worker process
+
+    Endpoints default to the share _init_worker gave this process.
+    """
+    endpoints = endpoints if endpoints is not None else _worker_endpoints
+    # Imported here so the parent process does not load the Gmail and Ollama clients
+    from ai_mail_agent import AIMailAgent
+
+    name = account['name']
+    started = time.perf_counter()
+    try:
+        agent = AIMailAgent(account.get('model', "deepseek-r1:8b"),
+                            data_dir=account.get('data_dir') or os.path.join('accounts', name),
+                            credentials_path=account.get('credentials_path'), endpoints=endpoints,
+                            fast_model=account.get('fast_model'),
+                            escalate_below=account.get('escalate_below', DEFAULT_ESCALATE_BELOW),
+                            digest_formats=account.get('digest_formats', ('md',)),
+                            keep_digest_days=account.get('keep_digest_days', DEFAULT_KEEP_DAYS))
+        reports = asyncio.run(agent.run_once_async(hours=account.get('hours', 24),
+                                                   use_cache=account.get('use_cache', True)))
+        return {
+            'account': name,
+            'ok': True,
+            'seconds': time.perf_counter() - started,
+            'summary': reports['summary'],
+            'important': [{field: email.get(field) for field in
+                           ('subject', 'sender', 'summary', 'category', 'priority_level', 'requires_action', 'deadline')}
+                          for email in reports['important']],
+        }
+    except Exception as e:
+        return {'account': name, 'ok': False, 'seconds': time.perf_counter() - started,
+                'error': f"{e}\n{traceback.format_exc()}"}
+
+
+def run_accounts(accounts: List[Dict], endpoints: Optional[List[Dict]] = None,
+                 processes: Optional[int] = None) -> List[Dict]:
+    """Process every account in a pool of worker processes, one account per task
+
+    Results come back in completion order. A failing account is reported
+    with ok=False and does not stop the others.
+    """
+    if not accounts:
+        return []
+    names = [account['name'] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError("Account names must be unique; they name each account's data directory")
+    endpoints = endpoints or DEFAULT_ENDPOINTS
+    # A process without a slot on any server could never make a model call
+    slots = sum(endpoint.get('concurrency', 4) for endpoint in endpoints)
+    processes = min(processes or min(len(accounts), os.cpu_count() or 1), slots)
+    context = get_context('spawn')
+    shares = share_endpoints(endpoints, processes)
+
+    results = []
+    # Spawned workers start without inherited SQLite handles or client threads
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker,
+                             initargs=(shares, context.Value('i', 0))) as pool:
+        futures = [pool.submit(run_account, account) for account in accounts]
+        for future in as_completed(futures):
+            result = future.result()
+            status = 'done' if result['ok'] else 'failed'
+            print(f"Account {result['account']} {status} in {result['seconds']:.1f}s")
+            results.append(result)
+    return results
@@ -0,0 +1,85 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import zlib
+from typing import Iterator, Optional
+from tools.metrics import metrics
+
+# zlib's default balance of speed and size; HTML-heavy bodies shrink several-fold
+COMPRESSION_LEVEL = 6
+
+
+def blob_key(data: bytes) -> str:
+    """Content address of a blob: the SHA-256 of its uncompressed bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def text_key(text: str) -> str:
+    return blob_key(text.encode('utf-8'))
+
+
+class BlobStore:
+    """Content-addressed, zlib-compressed files under a directory
+
+    Identical bodies and attachments are stored once. Blobs are written
+    atomically and read through a memory map, so nothing is loaded until a
+    caller actually asks for it.
+    """
+
+    def __init__(self, root: str = 'mail_blobs'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def __contains__(self, key: Optional[str]) -> bool:
+        return bool(key) and os.path.exists(self.path(key))
+
+    def put(self, data: bytes, key: Optional[str] = None) -> str:
+        """Store data if it is not there yet and return its key"""
+        key = key or blob_key(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        with metrics.span('blob.write'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(zlib.compress(data, COMPRESSION_LEVEL))
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        metrics.incr('blob.bytes_written', len(data))
+        return key
+
+    def get(self, key: str) -> bytes:
+        with metrics.span('blob.read'), open(self.path(key), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return zlib.decompress(mapped)
+
+    def put_text(self, text: str) -> str:
+        data = text.encode('utf-8')
+        return self.put(data, blob_key(data))
+
+    def get_text(self, key: str) -> str:
+        return self.get(key).decode('utf-8')
+
+    def keys(self) -> Iterator[str]:
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) == 2 and os.path.isdir(directory):
+                for rest in os.listdir(directory):
+                    # Skip half-written temporary files
+                    if not rest.startswith('tmp'):
+                        yield prefix + rest
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,221 @@
+import base64
+import codecs
+import html
+import re
+from html.parser import HTMLParser
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+from tools.metrics import metrics
+
+# Default body budget per prompt, roughly the 2000 characters prompts used to slice
+DEFAULT_BODY_TOKENS = 500
+# Bump whenever the cleaning steps change so cached prompt bodies are rebuilt
+PREPROCESS_VERSION = "1"
+
+# Attribution lines that introduce quoted history, e.g. "On Mon, 3 Jun 2024 at 10:02, Bob <b@x> wrote:"
+# (mail clients often wrap them over two lines)
+ATTRIBUTION_PATTERN = re.compile(r'^\s*(On\b.{0,200}?\bwrote|\S.{0,120}\b(a écrit|schrieb|escribió))\s*:\s*$',
+                                 re.IGNORECASE | re.DOTALL)
+# Outlook and friends start the quoted original with a separator or a header block
+QUOTE_SEPARATOR_PATTERNS = [
+    re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}\s*$', re.IGNORECASE),
+    re.compile(r'^\s*_{10,}\s*$'),
+]
+QUOTE_FROM_PATTERN = re.compile(r'^\s*From:\s.+$', re.IGNORECASE)
+QUOTE_SENT_PATTERN = re.compile(r'^\s*(Sent|Date):', re.IGNORECASE)
+SIGNATURE_PATTERNS = [
+    re.compile(r'^--\s?$'),
+    re.compile(r'^\s*Sent from my \w+', re.IGNORECASE),
+    re.compile(r'^\s*Get Outlook for \w+', re.IGNORECASE),
+]
+# Footer lines that carry no content: unsubscribe links, legal notices, "view in browser"
+BOILERPLATE_PATTERN = re.compile(
+    r'(\bunsubscribe\b|view (this email )?(in|as a) (your )?(browser|web page)|view online|'
+    r'manage (your )?(email )?(preferences|subscriptions?)|you (are )?receiv(ed|ing) this (email|message)|'
+    r'this (e-?mail|message) (and any attachments )?(is|are|may be) (confidential|intended)|'
+    r'privacy policy|all rights reserved|^\s*(©|\(c\)|copyright)\s)', re.IGNORECASE)
+URL_PATTERN = re.compile(r'https?://[^\s<>"\')\]]+')
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([\w.:-]+)"?', re.IGNORECASE)
+BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+              'blockquote', 'section', 'article', 'header', 'footer', 'hr'}
+SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n- ' if tag == 'li' else '\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(markup: str) -> str:
+    """Visible text of an HTML body, one line per block element"""
+    parser = _TextExtractor()
+    try:
+        parser.feed(markup)
+        parser.close()
+    except Exception:
+        # Badly broken markup: drop the tags and keep whatever text is left
+        return html.unescape(re.sub(r'<[^>]+>', ' ', markup))
+    text = ''.join(parser.parts)
+    text = '\n'.join(re.sub(r'[ \t\xa0]+', ' ', line).strip() for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def decode_bytes(data: bytes, charset: Optional[str] = None) -> str:
+    """Decode with the declared charset, falling back to UTF-8; undecodable bytes are replaced"""
+    try:
+        codec = codecs.lookup(charset or 'utf-8').name
+    except LookupError:
+        codec = 'utf-8'
+    return data.decode(codec, errors='replace')
+
+
+def _part_charset(part: Dict) -> Optional[str]:
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_PATTERN.search(header['value'])
+            return match.group(1) if match else None
+    return None
+
+
+def _find_parts(payload: Dict, found: Dict):
+    """Depth-first search for the first text/plain and text/html parts that have data"""
+    mime_type = payload.get('mimeType', '')
+    if mime_type in ('text/plain', 'text/html') and 'data' in payload.get('body', {}):
+        found.setdefault(mime_type, payload)
+    for part in payload.get('parts', []):
+        # Attached files are not part of the message text
+        if part.get('filename'):
+            continue
+        _find_parts(part, found)
+
+
+def extract_body(payload: Dict) -> str:
+    """Message text from a Gmail payload: text/plain if present, else text/html converted to text"""
+    found = {}
+    _find_parts(payload, found)
+    for mime_type in ('text/plain', 'text/html'):
+        part = found.get(mime_type)
+        if part is None:
+            continue
+        text = decode_bytes(base64.urlsafe_b64decode(part['body']['data']), _part_charset(part))
+        if mime_type == 'text/html':
+            text = html_to_text(text)
+        if text.strip():
+            return text
+    return ""
+
+
+def strip_quotes(body: str) -> str:
+    """Remove quoted history from a reply, keeping only the text the sender wrote"""
+    lines = body.splitlines()
+    kept = []
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith('>'):
+            continue
+        # Two-line attribution: "On Mon, 3 Jun 2024, Bob Smith <bob@x>\nwrote:"
+        joined = line + ' ' + lines[i + 1] if i + 1 < len(lines) else line
+        if ATTRIBUTION_PATTERN.match(line) or (line.lstrip().startswith('On ') and ATTRIBUTION_PATTERN.match(joined)):
+            break
+        if any(pattern.match(line) for pattern in QUOTE_SEPARATOR_PATTERNS):
+            break
+        # A "From:" header only marks quoted history when followed by Sent:/Date: within a few lines
+        if QUOTE_FROM_PATTERN.match(line) and any(QUOTE_SENT_PATTERN.match(following) for following in lines[i + 1:i + 4]):
+            break
+        kept.append(line)
+    return '\n'.join(kept).strip()
+
+
+def strip_signature(body: str) -> str:
+    """Remove a trailing signature block ("-- " delimiter, mobile client footers)"""
+    lines = body.splitlines()
+    for i, line in enumerate(lines):
+        # Only look in the tail so a stray "--" in the middle of a message is kept
+        if i >= len(lines) - 15 and any(pattern.match(line) for pattern in SIGNATURE_PATTERNS):
+            return '\n'.join(lines[:i]).strip()
+    return body.strip()
+
+
+def new_content(email: Dict) -> str:
+    """The part of an email's body the sender actually wrote in this message"""
+    body = email.get('body') or ''
+    return strip_signature(strip_quotes(body)) or body.strip()
+
+
+def shorten_urls(text: str) -> str:
+    """Replace each URL (tracking parameters and all) with its host"""
+    def host(match):
+        netloc = urlsplit(match.group(0)).netloc
+        return f"<{netloc[4:] if netloc.startswith('www.') else netloc}>" if netloc else ''
+    return URL_PATTERN.sub(host, text)
+
+
+def clean_text(text: str) -> str:
+    """Drop footer boilerplate, shorten URLs and collapse whitespace"""
+    source = shorten_urls(text).splitlines()
+    lines = []
+    for i, line in enumerate(source):
+        # Footers sit at the end; the same words early on may be the actual request
+        if i >= len(source) // 2 and len(line) < 300 and BOILERPLATE_PATTERN.search(line):
+            continue
+        line = re.sub(r'[ \t\xa0]+', ' ', line).strip()
+        # Keep at most one blank line in a row
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return '\n'.join(lines).strip()
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens, preferring a paragraph, sentence or word boundary"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max(0, max_tokens * 4 - 4)
+    cut = text[:limit]
+    for boundary in ('\n\n', '. ', '\n', ' '):
+        position = cut.rfind(boundary)
+        # Only back off to a boundary if that keeps most of the budget
+        if position >= limit * 0.8:
+            cut = cut[:position + (1 if boundary == '. ' else 0)]
+            break
+    return cut.rstrip() + ' [...]'
+
+
+def prompt_text(email: Dict, max_tokens: int = DEFAULT_BODY_TOKENS) -> str:
+    """Body text to put in a prompt: new content only, cleaned and cut to the token budget
+
+    The result is cached on the email (and persisted with it) per budget, so
+    each message is preprocessed once.
+    """
+    key = f"{PREPROCESS_VERSION}:{max_tokens}"
+    cache = email.get('prompt_bodies')
+    if cache and key in cache:
+        return cache[key]
+    with metrics.span('preprocess'):
+        text = truncate_to_budget(clean_text(new_content(email)), max_tokens)
+    # Entries from an older preprocessing version are dropped
+    cache = {k: v for k, v in (cache or {}).items() if k.startswith(f"{PREPROCESS_VERSION}:")}
+    cache[key] = text
+    email['prompt_bodies'] = cache
+    return text
@@ -0,0 +1,119 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+from typing import Dict, Iterable, Optional
+from tools.blob_store import text_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS classification_cache (
+    message_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (message_id, content_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_classification_cache_last_used ON classification_cache(last_used);
+"""
+
+
+def content_hash(email_data: Dict, model: str, prompt_version: str) -> str:
+    """Hash everything that influences a result
+
+    The body enters through its blob-store key, so emails whose body has not
+    been loaded yet hash without reading it.
+    """
+    h = hashlib.sha256()
+    body_key = email_data.get('body_ref') or text_key(email_data.get('body') or '')
+    for part in (email_data.get('subject', ''), email_data.get('sender', ''),
+                 body_key, model, prompt_version):
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ClassificationCache:
+    """Size-bounded LRU cache of LLM classification results, persisted in SQLite
+
+    Entries are keyed on message_id plus a content hash, so an edited message,
+    a different model or a new prompt version is a miss rather than a stale hit.
+    """
+
+    def __init__(self, db_path: str = 'mail_store.db', max_entries: int = 50000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def get(self, message_id: str, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT result FROM classification_cache WHERE message_id = ? AND content_hash = ?',
+                (message_id, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE classification_cache SET last_used = ? WHERE message_id = ? AND content_hash = ?',
+                    (time.time(), message_id, key))
+        return json.loads(row[0])
+
+    def get_many(self, keys: Iterable) -> Dict[str, Dict]:
+        """Look up (message_id, key) pairs; returns {message_id: result} for the hits"""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 400):
+                chunk = keys[start:start + 400]
+                where = ' OR '.join(['(message_id = ? AND content_hash = ?)'] * len(chunk))
+                params = [value for pair in chunk for value in pair]
+                for message_id, result in self.conn.execute(
+                        f'SELECT message_id, result FROM classification_cache WHERE {where}', params):
+                    found[message_id] = json.loads(result)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if found:
+                now = time.time()
+                with self.conn:
+                    self.conn.executemany(
+                        'UPDATE classification_cache SET last_used = ? WHERE message_id = ? AND content_hash = ?',
+                        [(now, mid, key) for mid, key in keys if mid in found])
+        return found
+
+    def put(self, message_id: str, key: str, result: Dict):
+        self.put_many([(message_id, key, result)])
+
+    def put_many(self, entries: Iterable):
+        """Store (message_id, key, result) tuples and evict least recently used entries"""
+        now = time.time()
+        rows = [(mid, key, json.dumps(result, ensure_ascii=False, default=str), now)
+                for mid, key, result in entries]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO classification_cache (message_id, content_hash, result, last_used) '
+                'VALUES (?, ?, ?, ?)', rows)
+            self._evict()
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM classification_cache')
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM classification_cache').fetchone()[0]
+
+    def _evict(self):
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                'DELETE FROM classification_cache WHERE rowid IN '
+                '(SELECT rowid FROM classification_cache ORDER BY last_used ASC LIMIT ?)', (excess,))
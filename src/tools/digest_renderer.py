@@ -0,0 +1,337 @@
+import hashlib
+import html
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from tools.digest_writer import format_action_item, format_category_item, format_priority_item
+from tools.email_record import EmailBatch
+from tools.metrics import metrics
+from tools.threads import group_by_thread, thread_representative
+
+# Fields of a conversation's entry that appear in any digest format
+ITEM_FIELDS = ('subject', 'sender', 'category', 'priority_level', 'importance_score', 'requires_action',
+               'suggested_action', 'deadline', 'summary')
+DEFAULT_KEEP_DAYS = 30
+STATE_FILE = '.digest_state.json'
+# Bump when section renders change so cached renders from older versions are discarded
+STATE_VERSION = 1
+# Timestamped snapshots (mail_digest_YYYYMMDD_HHMMSS) and daily archives (mail_digest_YYYYMMDD)
+DIGEST_FILE_PATTERN = re.compile(r'^mail_digest_(\d{8})(?:_\d{6})?\.(md|html|json)$')
+# The umask can only be read by setting it; done once at import, before any threads write digests
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# (label, field, default) lines under each entry, per section kind
+ITEM_LINES = {
+    'priority': (('From', 'sender', ''), ('Priority', 'priority_level', 'Not specified'),
+                 ('Action Required', 'requires_action', False),
+                 ('Summary', 'summary', 'No summary available')),
+    'category': (('From', 'sender', ''), ('Priority', 'priority_level', 'Not specified'),
+                 ('Summary', 'summary', 'No summary available')),
+    'actions': (('From', 'sender', ''), ('Priority', 'priority_level', 'Not specified'),
+                ('Action', 'suggested_action', 'Review required'), ('Deadline', 'deadline', 'Not specified')),
+}
+
+
+def digest_item(email) -> Dict:
+    """Display fields of one entry as plain values; unset fields are left out"""
+    item = {}
+    for field in ITEM_FIELDS:
+        value = email.get(field)
+        if value is not None:
+            item[field] = str(value) if field in ('category', 'priority_level') else value
+    return item
+
+
+def fingerprint(section: Dict) -> str:
+    """Stable hash of everything a section renders from"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{section['kind']}\0{section['title']}".encode('utf-8'))
+    for item in section['items']:
+        h.update(b'\0')
+        h.update(repr(tuple(item.items())).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _section(section_id, kind, title, items):
+    section = {'id': section_id, 'kind': kind, 'title': title, 'items': items}
+    section['fingerprint'] = fingerprint(section)
+    return section
+
+
+def build_digest(emails: List[Dict], hours: int = 24, now: Optional[datetime] = None) -> Dict:
+    """Render model shared by every digest format
+
+    One entry per conversation, from its latest message. Sections come in a
+    fixed order: priority items, one section per category, action items.
+    Each has a stable id and a fingerprint of its entries, so a render can
+    be reused while the fingerprint is unchanged.
+    """
+    threads = EmailBatch([thread_representative(messages) for messages in group_by_thread(emails).values()])
+    items = [digest_item(email) for email in threads.records]
+    groups = threads.group_by_category()
+    sections = [_section('priority', 'priority', 'Priority Items',
+                         [items[i] for i in np.flatnonzero(threads.important())])]
+    sections.extend(_section(f'category:{category}', 'category', str(category), [items[i] for i in indices])
+                    for category, indices in groups.items())
+    sections.append(_section('actions', 'actions', 'Action Items',
+                             [items[i] for i in np.flatnonzero(threads.requires_action)]))
+    return {
+        'date': (now or datetime.now()).strftime('%Y-%m-%d'),
+        'hours': hours,
+        'total': len(emails),
+        'conversations': len(threads),
+        'categories': [str(category) for category in groups],
+        'sections': sections,
+    }
+
+
+class MarkdownRenderer:
+    extension = 'md'
+    formatters = {'priority': format_priority_item, 'category': format_category_item, 'actions': format_action_item}
+
+    def section(self, section: Dict) -> str:
+        items = section['items']
+        body = ''.join(map(self.formatters[section['kind']], items))
+        if section['kind'] == 'category':
+            return f"\n### {section['title']} ({len(items)} conversations)\n{body}"
+        if not items:
+            return ''
+        heading = "\n### Priority Items\n" if section['kind'] == 'priority' else "\n## Action Items\n"
+        return heading + body
+
+    def document(self, model: Dict, parts: List[str]) -> str:
+        return f"""# Email Digest for {model['date']}
+
+## Overview
+- Total Emails: {model['total']}
+- Conversations: {model['conversations']}
+- Time Period: Last {model['hours']} hours
+- Categories Found: {', '.join(model['categories'])}
+
+## Important Highlights
+{parts[0]}
+## Category Breakdown
+{''.join(parts[1:-1])}{parts[-1]}"""
+
+
+class HtmlRenderer:
+    extension = 'html'
+
+    def section(self, section: Dict) -> str:
+        items = section['items']
+        if section['kind'] != 'category' and not items:
+            return ''
+        entries = ''.join(self._item(item, ITEM_LINES[section['kind']]) for item in items)
+        if section['kind'] == 'category':
+            heading = f"<h3>{html.escape(section['title'])} ({len(items)} conversations)</h3>"
+        elif section['kind'] == 'priority':
+            heading = "<h3>Priority Items</h3>"
+        else:
+            heading = "<h2>Action Items</h2>"
+        return f"{heading}\n<ul>\n{entries}</ul>\n"
+
+    def _item(self, item: Dict, lines) -> str:
+        details = ''.join(f"<li>{label}: {html.escape(str(item.get(field, default)))}</li>"
+                          for label, field, default in lines)
+        return f"<li><strong>{html.escape(item.get('subject', ''))}</strong><ul>{details}</ul></li>\n"
+
+    def document(self, model: Dict, parts: List[str]) -> str:
+        categories = html.escape(', '.join(model['categories']))
+        return f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Email Digest for {model['date']}</title></head>
+<body>
+<h1>Email Digest for {model['date']}</h1>
+<h2>Overview</h2>
+<ul>
+<li>Total Emails: {model['total']}</li>
+<li>Conversations: {model['conversations']}</li>
+<li>Time Period: Last {model['hours']} hours</li>
+<li>Categories Found: {categories}</li>
+</ul>
+<h2>Important Highlights</h2>
+{parts[0]}<h2>Category Breakdown</h2>
+{''.join(parts[1:-1])}{parts[-1]}</body>
+</html>
+"""
+
+
+class JsonRenderer:
+    extension = 'json'
+
+    def section(self, section: Dict) -> str:
+        return json.dumps({key: section[key] for key in ('id', 'kind', 'title', 'items')},
+                          ensure_ascii=False, default=str)
+
+    def document(self, model: Dict, parts: List[str]) -> str:
+        head = json.dumps({key: value for key, value in model.items() if key != 'sections'}, ensure_ascii=False)
+        return f"{head[:-1]}, \"sections\": [{', '.join(parts)}]}}\n"
+
+
+RENDERERS = {renderer.extension: renderer for renderer in (MarkdownRenderer(), HtmlRenderer(), JsonRenderer())}
+DIGEST_FORMATS = tuple(RENDERERS)
+
+
+def render(model: Dict, fmt: str = 'md') -> str:
+    """Render a whole digest from its model in one format"""
+    renderer = RENDERERS[fmt]
+    return renderer.document(model, [renderer.section(section) for section in model['sections']])
+
+
+def write_atomic(path: str, text: str):
+    """Replace a file in one step, so readers never see a half-written digest"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        # mkstemp creates owner-only files; give digests the mode a plain open() would
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def compact_digests(digest_folder: str, keep_days: Optional[int] = DEFAULT_KEEP_DAYS,
+                    now: Optional[datetime] = None) -> int:
+    """Collapse past digests to one file per day and format, and delete days older than keep_days
+
+    Of a past day's timestamped snapshots and archive, only the newest is
+    kept, named mail_digest_YYYYMMDD.<ext>. Today's files are left alone and
+    keep_days=None keeps every day. Returns the number of files removed.
+    """
+    now = now or datetime.now()
+    today = now.strftime('%Y%m%d')
+    cutoff = (now - timedelta(days=keep_days)).strftime('%Y%m%d') if keep_days is not None else None
+    by_day = {}
+    for name in os.listdir(digest_folder):
+        match = DIGEST_FILE_PATTERN.match(name)
+        if match and match.group(1) < today:
+            by_day.setdefault(match.groups(), []).append(os.path.join(digest_folder, name))
+
+    removed = 0
+    for (day, extension), paths in by_day.items():
+        if cutoff is not None and day < cutoff:
+            keep, drop = None, paths
+        else:
+            paths.sort(key=os.path.getmtime)
+            keep, drop = paths[-1], paths[:-1]
+        for path in drop:
+            os.remove(path)
+            removed += 1
+        target = os.path.join(digest_folder, f"mail_digest_{day}.{extension}")
+        if keep and keep != target:
+            os.replace(keep, target)
+    metrics.incr('digest.files_compacted', removed)
+    return removed
+
+
+class IncrementalDigest:
+    """Digest kept at a stable path (mail_digest.<ext>) and updated in place
+
+    Each section's render is cached with the fingerprint of its entries, so
+    an update re-renders only the sections whose emails changed and rewrites
+    a file only when its content differs. The cache is kept in
+    .digest_state.json and survives restarts. When the date changes, the
+    previous day's files are archived as mail_digest_YYYYMMDD.<ext> and past
+    digests are compacted (see compact_digests).
+    """
+
+    def __init__(self, digest_folder: str = 'mail_digests', formats: Iterable[str] = ('md',),
+                 keep_days: Optional[int] = DEFAULT_KEEP_DAYS):
+        unknown = set(formats) - set(RENDERERS)
+        if unknown:
+            raise ValueError(f"Unknown digest formats: {', '.join(sorted(unknown))}")
+        self.folder = digest_folder
+        # Markdown is always written; it is what the reports return
+        self.formats = ('md',) + tuple(fmt for fmt in dict.fromkeys(formats) if fmt != 'md')
+        self.keep_days = keep_days
+        self.state_path = os.path.join(digest_folder, STATE_FILE)
+        self._state = None
+        os.makedirs(digest_folder, exist_ok=True)
+
+    def path(self, fmt: str = 'md') -> str:
+        return os.path.join(self.folder, f"mail_digest.{fmt}")
+
+    def update(self, emails: List[Dict], hours: int = 24, now: Optional[datetime] = None) -> Dict[str, str]:
+        """Bring the digest files up to date with emails; returns the document of each format"""
+        now = now or datetime.now()
+        state = self._load_state(now)
+        today = now.strftime('%Y-%m-%d')
+        if state['date'] != today:
+            self._archive(state['date'], now)
+            state = self._state = self._empty_state(today)
+
+        dirty = False
+        with metrics.span('digest.render'):
+            model = build_digest(emails, hours, now)
+            cached, sections = state['sections'], {}
+            for section in model['sections']:
+                entry = cached.get(section['id'])
+                if entry is None or entry['fingerprint'] != section['fingerprint'] or \
+                        any(fmt not in entry for fmt in self.formats):
+                    entry = {'fingerprint': section['fingerprint']}
+                    entry.update((fmt, RENDERERS[fmt].section(section)) for fmt in self.formats)
+                    metrics.incr('digest.sections_rendered')
+                    dirty = True
+                else:
+                    metrics.incr('digest.sections_reused')
+                sections[section['id']] = entry
+            dirty = dirty or sections.keys() != cached.keys()
+            state['sections'] = sections
+            documents = {fmt: RENDERERS[fmt].document(model, [sections[s['id']][fmt] for s in model['sections']])
+                         for fmt in self.formats}
+
+        with metrics.span('digest.write'):
+            for fmt, text in documents.items():
+                checksum = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+                if state['documents'].get(fmt) == checksum and os.path.exists(self.path(fmt)):
+                    metrics.incr('digest.unchanged')
+                    continue
+                write_atomic(self.path(fmt), text)
+                state['documents'][fmt] = checksum
+                dirty = True
+            if dirty:
+                write_atomic(self.state_path, json.dumps(state, ensure_ascii=False))
+        return documents
+
+    def _empty_state(self, date: str) -> Dict:
+        return {'version': STATE_VERSION, 'date': date, 'sections': {}, 'documents': {}}
+
+    def _load_state(self, now: datetime) -> Dict:
+        if self._state is not None:
+            return self._state
+        state = None
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Error reading digest state, rendering from scratch: {e}")
+        if not state or state.get('version') != STATE_VERSION:
+            state = self._empty_state(now.strftime('%Y-%m-%d'))
+        # Snapshots left by earlier runs are compacted once per process
+        self._compact(now)
+        self._state = state
+        return state
+
+    def _archive(self, date: str, now: datetime):
+        """Move the previous day's stable files to that day's archive names"""
+        day = date.replace('-', '')
+        for fmt in DIGEST_FORMATS:
+            if os.path.exists(self.path(fmt)):
+                os.replace(self.path(fmt), os.path.join(self.folder, f"mail_digest_{day}.{fmt}"))
+        self._compact(now)
+
+    def _compact(self, now: datetime):
+        try:
+            compact_digests(self.folder, self.keep_days, now)
+        except OSError as e:
+            print(f"Error compacting old digests: {e}")
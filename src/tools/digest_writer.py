@@ -0,0 +1,122 @@
+import os
+import tempfile
+from datetime import datetime
+from tools.metrics import metrics
+from tools.threads import thread_key, thread_representative
+
+
+def is_important(email):
+    return float(email.get('importance_score') or 0) > 0.7 or email.get('requires_action', False)
+
+
+def format_priority_item(email):
+    return f"""
+- **{email['subject']}**
+  - From: {email['sender']}
+  - Priority: {email.get('priority_level', 'Not specified')}
+  - Action Required: {email.get('requires_action', False)}
+  - Summary: {email.get('summary', 'No summary available')}
+"""
+
+
+def format_category_item(email):
+    return f"""
+- **{email['subject']}**
+  - From: {email['sender']}
+  - Priority: {email.get('priority_level', 'Not specified')}
+  - Summary: {email.get('summary', 'No summary available')}
+"""
+
+
+def format_stream_item(email):
+    return f"""
+- **{email['subject']}**
+  - Category: {email.get('category', 'Uncategorized')}
+  - From: {email['sender']}
+  - Priority: {email.get('priority_level', 'Not specified')}
+  - Summary: {email.get('summary', 'No summary available')}
+"""
+
+
+def format_action_item(email):
+    return f"""
+- [ ] **{email['subject']}** from {email['sender']}
+  - Priority: {email.get('priority_level', 'Not specified')}
+  - Action: {email.get('suggested_action', 'Review required')}
+  - Deadline: {email.get('deadline', 'Not specified')}
+"""
+
+
+class DigestWriter:
+    """Append-only markdown digest that writes each email as soon as it is processed
+
+    Only counters are kept in memory. Priority and action items are spooled to
+    temporary files and appended, with the overview, when the writer closes.
+    Emails should arrive newest first: a thread is written once, for its first
+    (latest) message, and later messages of the same thread are only counted.
+    """
+
+    def __init__(self, digest_folder="mail_digests", hours=24):
+        self.hours = hours
+        self.started = datetime.now()
+        filename = f"mail_digest_{self.started.strftime('%Y%m%d_%H%M%S')}.md"
+        self.path = os.path.join(digest_folder, filename)
+        self.total = 0
+        self.actions = 0
+        self.category_counts = {}
+        self.threads = set()
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._priority_spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._action_spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._file.write(f"# Email Digest for {self.started.strftime('%Y-%m-%d')}\n\n"
+                         f"- Time Period: Last {hours} hours\n\n## Emails\n")
+        self._file.flush()
+
+    def add(self, email):
+        """Write one processed email to the digest immediately"""
+        self.total += 1
+        key = thread_key(email)
+        if key in self.threads:
+            return
+        self.threads.add(key)
+        email = thread_representative([email])
+        category = email.get('category', 'Uncategorized')
+        self.category_counts[category] = self.category_counts.get(category, 0) + 1
+        with metrics.span('digest.write'):
+            self._file.write(format_stream_item(email))
+            self._file.flush()
+            if is_important(email):
+                self._priority_spool.write(format_priority_item(email))
+            if email.get('requires_action', False):
+                self.actions += 1
+                self._action_spool.write(format_action_item(email))
+
+    def close(self):
+        """Append the overview, priority items and action items, then close the file"""
+        if self._file.closed:
+            return
+        breakdown = ', '.join(f"{category} ({count})" for category, count in self.category_counts.items())
+        self._file.write(f"\n## Overview\n- Total Emails: {self.total}\n"
+                         f"- Conversations: {len(self.threads)}\n"
+                         f"- Time Period: Last {self.hours} hours\n"
+                         f"- Categories Found: {breakdown}\n")
+        self._append_spool("\n## Important Highlights\n\n### Priority Items\n", self._priority_spool)
+        self._append_spool("\n## Action Items\n", self._action_spool)
+        self._file.close()
+        print(f"\nDaily digest saved to: {self.path}")
+
+    def _append_spool(self, heading, spool):
+        if spool.tell() == 0:
+            spool.close()
+            return
+        self._file.write(heading)
+        spool.seek(0)
+        for line in spool:
+            self._file.write(line)
+        spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
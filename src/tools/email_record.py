@@ -0,0 +1,349 @@
+import marshal
+from collections.abc import MutableMapping
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from tools.blob_store import BlobStore
+
+IMPORTANCE_THRESHOLD = 0.7
+# Bump when the state layout of EmailRecord changes; load_records rejects other versions
+RECORD_FORMAT = 1
+
+
+class _Label(str, Enum):
+    """String-valued enum: members compare equal to, format and serialize as their value"""
+
+    __str__ = str.__str__
+    __format__ = str.__format__
+    # Hash like the plain string so members and strings are interchangeable as dict keys
+    __hash__ = str.__hash__
+
+    @classmethod
+    def parse(cls, value):
+        """Member for a value, matched case-insensitively; None for None, a default for unknown values"""
+        if value is None or isinstance(value, cls):
+            return value
+        member = _LOOKUP[cls].get(str(value).strip().lower())
+        if member is None:
+            member = cls._missing_label()
+            if (cls, value) not in _WARNED:
+                _WARNED.add((cls, value))
+                print(f"Unknown {cls.__name__.lower()} {value!r}, using {member.value}")
+        return member
+
+    @classmethod
+    def _missing_label(cls):
+        raise NotImplementedError
+
+
+class Category(_Label):
+    WORK = 'Work'
+    PERSONAL = 'Personal'
+    FINANCE = 'Finance'
+    SHOPPING = 'Shopping'
+    SOCIAL = 'Social'
+    NEWS = 'News'
+    SPAM = 'Spam'
+    UNCATEGORIZED = 'Uncategorized'
+
+    @classmethod
+    def _missing_label(cls):
+        # Unknown labels (e.g. from an older prompt) are treated as unclassified
+        return cls.UNCATEGORIZED
+
+
+class Priority(_Label):
+    LOW = 'Low'
+    MEDIUM = 'Medium'
+    HIGH = 'High'
+    URGENT = 'Urgent'
+
+    @classmethod
+    def _missing_label(cls):
+        # Unknown priorities (e.g. "Critical" from an older prompt) still render and sort
+        return cls.MEDIUM
+
+
+# (enum, value) pairs already reported as unknown, so each is printed once
+_WARNED = set()
+_LOOKUP = {cls: {member.value.lower(): member for member in cls} for cls in (Category, Priority)}
+CATEGORIES = list(Category)
+PRIORITIES = list(Priority)
+_CATEGORY_CODES = {member: code for code, member in enumerate(CATEGORIES)}
+_PRIORITY_CODES = {member: code for code, member in enumerate(PRIORITIES)}
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _to_bool(value):
+    return None if value is None else bool(value)
+
+
+def _to_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+# Fields with a slot of their own, and how values are normalized when set
+FIELD_TYPES = {
+    'message_id': None,
+    'thread_id': None,
+    'subject': None,
+    'sender': None,
+    'date': _to_datetime,
+    'body_ref': None,
+    'labels': None,
+    'category': Category.parse,
+    'importance_score': _to_float,
+    'requires_action': _to_bool,
+    'priority_level': Priority.parse,
+    'suggested_action': None,
+    'deadline': None,
+    'summary': None,
+    'thread_summary': None,
+    'duplicate_of': None,
+    'list_unsubscribe': None,
+    'precedence': None,
+    'auto_submitted': None,
+}
+FIELDS = tuple(FIELD_TYPES)
+_FIELD_SET = frozenset(FIELDS) | {'body'}
+_DATE, _CATEGORY, _PRIORITY = (FIELDS.index(name) for name in ('date', 'category', 'priority_level'))
+# Blob stores shared by deserialized records, one per directory
+_BLOB_STORES: Dict[str, BlobStore] = {}
+
+
+class EmailRecord(MutableMapping):
+    """One email as a slotted object with interned category and priority
+
+    Known fields are attributes; anything else (prompt caches, attachments,
+    search scores, ...) goes to `extra`. The record also behaves as a
+    mapping, so code written for email dicts keeps working: a field that is
+    None reads as missing, which keeps `email.get(field, default)` and
+    `field in email` meaningful.
+
+    The body is read from the blob store on first access when the record
+    only has a `body_ref`.
+    """
+
+    __slots__ = FIELDS + ('_body', '_blobs', 'extra')
+
+    def __init__(self, data: Optional[Dict] = None, blobs: Optional[BlobStore] = None, **fields):
+        for name in FIELDS:
+            object.__setattr__(self, name, None)
+        self._body = None
+        self._blobs = blobs
+        self.extra = {}
+        for source in (data or {}, fields):
+            for key, value in source.items():
+                self[key] = value
+
+    @classmethod
+    def of(cls, email) -> 'EmailRecord':
+        """The email itself when it already is a record, else a record built from the dict"""
+        return email if isinstance(email, EmailRecord) else cls(email)
+
+    @property
+    def body(self) -> Optional[str]:
+        if self._body is None and self.body_ref and self._blobs is not None:
+            self._body = self._blobs.get_text(self.body_ref)
+        return self._body
+
+    @body.setter
+    def body(self, value: Optional[str]):
+        self._body = value
+
+    @property
+    def loaded_body(self) -> Optional[str]:
+        """The body if it is in memory, without reading the blob store"""
+        return self._body
+
+    @property
+    def date_ts(self) -> float:
+        return self.date.timestamp() if self.date else 0.0
+
+    def is_important(self, threshold: float = IMPORTANCE_THRESHOLD) -> bool:
+        return (self.importance_score or 0) > threshold or bool(self.requires_action)
+
+    def __setattr__(self, name, value):
+        convert = FIELD_TYPES.get(name)
+        object.__setattr__(self, name, convert(value) if convert and value is not None else value)
+
+    # Mapping protocol
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key) is not None
+        return key in self.extra
+
+    def __iter__(self) -> Iterator[str]:
+        for name in FIELDS:
+            if getattr(self, name) is not None:
+                yield name
+        if self._body is not None:
+            yield 'body'
+        yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"EmailRecord(message_id={self.message_id!r}, subject={self.subject!r})"
+
+    def copy(self) -> 'EmailRecord':
+        """Shallow copy sharing the body and blob store"""
+        clone = EmailRecord.__new__(EmailRecord)
+        for name in FIELDS:
+            object.__setattr__(clone, name, getattr(self, name))
+        clone._body = self._body
+        clone._blobs = self._blobs
+        clone.extra = dict(self.extra)
+        return clone
+
+    def to_dict(self) -> Dict:
+        """Plain dict of the set fields, with the body only if it is already loaded"""
+        return dict(self.items())
+
+    # Binary serialization
+
+    def to_state(self) -> tuple:
+        """Compact tuple of primitives (enums as small ints, date as ISO text) for marshal/pickle"""
+        values = [getattr(self, name) for name in FIELDS]
+        values[_DATE] = self.date.isoformat() if self.date else None
+        values[_CATEGORY] = _CATEGORY_CODES.get(self.category)
+        values[_PRIORITY] = _PRIORITY_CODES.get(self.priority_level)
+        return (tuple(values), self._body, self._blobs.root if self._blobs else None, self.extra)
+
+    @classmethod
+    def from_state(cls, state: tuple) -> 'EmailRecord':
+        values, body, blob_root, extra = state
+        values = list(values)
+        if values[_DATE] is not None:
+            values[_DATE] = datetime.fromisoformat(values[_DATE])
+        if values[_CATEGORY] is not None:
+            values[_CATEGORY] = CATEGORIES[values[_CATEGORY]]
+        if values[_PRIORITY] is not None:
+            values[_PRIORITY] = PRIORITIES[values[_PRIORITY]]
+        record = cls.__new__(cls)
+        for set_slot, value in zip(_SLOT_SETTERS, values):
+            set_slot(record, value)
+        setter = object.__setattr__
+        setter(record, '_body', body)
+        blobs = None
+        if blob_root:
+            blobs = _BLOB_STORES.get(blob_root)
+            if blobs is None:
+                blobs = _BLOB_STORES[blob_root] = BlobStore(blob_root)
+        setter(record, '_blobs', blobs)
+        setter(record, 'extra', dict(extra))
+        return record
+
+    def __reduce__(self):
+        # Pickled (e.g. for worker processes) as the compact state, with enums as small ints
+        return EmailRecord.from_state, (self.to_state(),)
+
+
+# Slot descriptors' setters skip attribute lookup and normalization when rebuilding records
+_SLOT_SETTERS = tuple(EmailRecord.__dict__[name].__set__ for name in FIELDS)
+
+
+def dump_records(records: Iterable[EmailRecord]) -> bytes:
+    """Serialize records as marshalled tuples of primitives
+
+    About half the size of the same emails as JSON, and load_records returns
+    typed records (datetimes, enums) directly. The format is tied to
+    RECORD_FORMAT and the Python version, so use it for caches and process
+    hand-offs rather than long-term storage.
+    """
+    return marshal.dumps((RECORD_FORMAT, [EmailRecord.of(record).to_state() for record in records]))
+
+
+def load_records(data: bytes) -> List[EmailRecord]:
+    version, states = marshal.loads(data)
+    if version != RECORD_FORMAT:
+        raise ValueError(f"Unsupported email record format {version}")
+    return [EmailRecord.from_state(state) for state in states]
+
+
+class EmailBatch:
+    """Columnar view over a list of records for vectorized filtering, grouping and sorting
+
+    Category and priority are int8 codes (-1 when unset), importance is
+    float32 (NaN when unset) and dates are POSIX timestamps. Row i of every
+    column belongs to records[i].
+    """
+
+    def __init__(self, records: List[EmailRecord]):
+        self.records = [EmailRecord.of(record) for record in records]
+        count = len(self.records)
+        self.category = np.fromiter((_CATEGORY_CODES.get(r.category, -1) for r in self.records),
+                                    dtype=np.int8, count=count)
+        self.priority = np.fromiter((_PRIORITY_CODES.get(r.priority_level, -1) for r in self.records),
+                                    dtype=np.int8, count=count)
+        self.importance = np.fromiter((np.nan if r.importance_score is None else r.importance_score
+                                       for r in self.records), dtype=np.float32, count=count)
+        self.requires_action = np.fromiter((bool(r.requires_action) for r in self.records),
+                                           dtype=bool, count=count)
+        self.date_ts = np.fromiter((r.date_ts for r in self.records), dtype=np.float64, count=count)
+
+    def __len__(self):
+        return len(self.records)
+
+    def important(self, threshold: float = IMPORTANCE_THRESHOLD) -> np.ndarray:
+        """Boolean mask of records above the importance threshold or requiring action"""
+        with np.errstate(invalid='ignore'):
+            return (self.importance > threshold) | self.requires_action
+
+    def take(self, selector) -> List[EmailRecord]:
+        """Records for a boolean mask or an index array, in that order"""
+        indices = np.flatnonzero(selector) if getattr(selector, 'dtype', None) == bool else selector
+        return [self.records[i] for i in indices]
+
+    def category_counts(self) -> Dict[Category, int]:
+        """Records per category, unset counted as Uncategorized"""
+        codes = np.where(self.category < 0, _CATEGORY_CODES[Category.UNCATEGORIZED], self.category)
+        counts = np.bincount(codes, minlength=len(CATEGORIES))
+        return {CATEGORIES[code]: int(count) for code, count in enumerate(counts) if count}
+
+    def group_by_category(self) -> Dict[Category, np.ndarray]:
+        """Row indices per category, categories in order of first appearance, rows in input order"""
+        codes = np.where(self.category < 0, _CATEGORY_CODES[Category.UNCATEGORIZED], self.category)
+        order = np.argsort(codes, kind='stable')
+        values, starts = np.unique(codes[order], return_index=True)
+        groups = {CATEGORIES[code]: indices for code, indices in zip(values, np.split(order, starts[1:]))}
+        return dict(sorted(groups.items(), key=lambda item: item[1][0]))
+
+    def order_by_category_and_importance(self) -> np.ndarray:
+        """Row indices grouped by category, most important first within each"""
+        importance = np.nan_to_num(self.importance, nan=0.5)
+        return np.lexsort((-importance, self.category))
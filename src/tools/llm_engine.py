@@ -0,0 +1,291 @@
+import ollama
+import asyncio
+import contextlib
+import httpx
+import threading
+from tools.metrics import metrics
+from tools.structured_output import JsonObjectScanner
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Streamed chunks tolerated after a JSON answer closes before generation is cut off;
+# JSON mode can otherwise keep emitting whitespace until num_predict runs out
+JSON_TRAILING_CHUNKS = 8
+
+
+class Endpoint:
+    """One Ollama server: its clients, concurrency limit and current load
+
+    models restricts the endpoint to those model names; None serves any model.
+    """
+
+    def __init__(self, host: Optional[str] = None, concurrency: int = 4, models: Optional[List[str]] = None):
+        self.host = host
+        self.concurrency = concurrency
+        self.models = set(models) if models else None
+        self.in_flight = 0
+        self.client = None
+        # The module-level functions read OLLAMA_HOST, like the default client always did
+        self.sync_client = ollama.Client(host=host) if host else ollama
+
+    @property
+    def name(self) -> str:
+        return self.host or 'default'
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.concurrency
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+
+class LLMEngine:
+    """Runs Ollama chat calls concurrently on AsyncClients with bounded parallelism
+
+    Requests go to the least-loaded endpoint that serves the model, and each
+    endpoint's concurrency limit should match its OLLAMA_NUM_PARALLEL; extra
+    requests only queue up inside Ollama and inflate per-request latency.
+    Without `endpoints`, a single endpoint is built from `host` and `concurrency`.
+    """
+
+    def __init__(self, model_name="deepseek-r1:8b", host: Optional[str] = None,
+                 concurrency: int = 4, timeout: float = 300.0, max_retries: int = 2,
+                 endpoints: Optional[List[Dict]] = None):
+        self.model = model_name
+        self.endpoints = [Endpoint(**config) for config in endpoints] if endpoints else \
+            [Endpoint(host, concurrency)]
+        self.host = self.endpoints[0].host
+        self.concurrency = sum(endpoint.concurrency for endpoint in self.endpoints)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # Clients and the slot condition are bound to the event loop they were created on
+        self._loop = None
+        self._available = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> ollama.AsyncClient:
+        self._bind_loop()
+        return self.endpoints[0].client
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            for endpoint in self.endpoints:
+                endpoint.client = ollama.AsyncClient(host=endpoint.host)
+                endpoint.in_flight = 0
+            self._available = asyncio.Condition()
+
+    def _candidates(self, model: str) -> List[Endpoint]:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.serves(model)]
+        if not candidates:
+            raise ValueError(f"No Ollama endpoint serves model {model}")
+        return candidates
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, model: str):
+        """Hold a request slot on the least-loaded endpoint serving model, waiting while all are full"""
+        self._bind_loop()
+        candidates = self._candidates(model)
+        async with self._available:
+            while True:
+                free = [endpoint for endpoint in candidates if endpoint.in_flight < endpoint.concurrency]
+                if free:
+                    endpoint = min(free, key=lambda e: e.load)
+                    endpoint.in_flight += 1
+                    break
+                await self._available.wait()
+        metrics.incr(f'endpoint.{endpoint.name}')
+        try:
+            yield endpoint
+        finally:
+            async with self._available:
+                endpoint.in_flight -= 1
+                self._available.notify()
+
+    @contextlib.contextmanager
+    def _sync_slot(self, model: str):
+        # Blocking callers are not bounded; they only steer towards the idlest endpoint
+        candidates = self._candidates(model)
+        with self._lock:
+            endpoint = min(candidates, key=lambda e: e.load)
+            endpoint.in_flight += 1
+        metrics.incr(f'endpoint.{endpoint.name}')
+        try:
+            yield endpoint
+        finally:
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def chat_sync(self, prompt: str, model: Optional[str] = None, stage: str = 'llm', **kwargs):
+        """Blocking single-turn chat request, timed and recorded under `stage`"""
+        model = model or self.model
+        with self._sync_slot(model) as endpoint, metrics.span(stage):
+            response = endpoint.sync_client.chat(
+                model=model,
+                messages=[{'role': 'user', 'content': prompt}],
+                **kwargs)
+        metrics.record_llm(stage, response, model)
+        return response
+
+    async def chat(self, prompt: str, model: Optional[str] = None, stage: str = 'llm', **kwargs):
+        """Send a single-turn chat request, retrying timeouts and transient server errors"""
+        model = model or self.model
+
+        async def call():
+            async with self._slot(model) as endpoint:
+                with metrics.span(stage):
+                    response = await asyncio.wait_for(
+                        endpoint.client.chat(
+                            model=model,
+                            messages=[{'role': 'user', 'content': prompt}],
+                            **kwargs),
+                        timeout=self.timeout)
+            metrics.record_llm(stage, response, model)
+            return response
+
+        return await self._retrying(stage, call)
+
+    def chat_json_sync(self, prompt: str, model: Optional[str] = None, stage: str = 'llm',
+                       format: Any = 'json', **kwargs) -> str:
+        """Blocking JSON-constrained chat that stops generating once the top-level object is complete
+
+        format is 'json' or a JSON schema. When the model keeps generating after
+        the object closes, the stream is dropped, which makes Ollama stop; a
+        normal end still records the final token statistics. Returns the
+        object text, or the whole answer when no complete object was produced.
+        """
+        model = model or self.model
+        with self._sync_slot(model) as endpoint, metrics.span(stage):
+            stream = endpoint.sync_client.chat(
+                model=model, messages=[{'role': 'user', 'content': prompt}], format=format, stream=True, **kwargs)
+            state = {'scanner': JsonObjectScanner(), 'text': [], 'object': None, 'trailing': 0}
+            response = None
+            try:
+                for part in stream:
+                    response = self._scan_part(part, state)
+                    if response is not None:
+                        break
+            finally:
+                stream.close()
+        return self._finish_json(stage, model, state, response)
+
+    async def chat_json(self, prompt: str, model: Optional[str] = None, stage: str = 'llm',
+                        format: Any = 'json', **kwargs) -> str:
+        """Async variant of chat_json_sync, with the retry policy of chat()"""
+        model = model or self.model
+
+        async def read(endpoint):
+            stream = await endpoint.client.chat(
+                model=model, messages=[{'role': 'user', 'content': prompt}], format=format, stream=True, **kwargs)
+            state = {'scanner': JsonObjectScanner(), 'text': [], 'object': None, 'trailing': 0}
+            response = None
+            try:
+                async for part in stream:
+                    response = self._scan_part(part, state)
+                    if response is not None:
+                        break
+            finally:
+                # Closing the stream drops the connection, which makes Ollama stop generating
+                await stream.aclose()
+            return state, response
+
+        async def call():
+            async with self._slot(model) as endpoint:
+                with metrics.span(stage):
+                    state, response = await asyncio.wait_for(read(endpoint), timeout=self.timeout)
+            return self._finish_json(stage, model, state, response)
+
+        return await self._retrying(stage, call)
+
+    def _scan_part(self, part, state: Dict):
+        """Feed one streamed chunk; returns the response to record once reading should stop"""
+        content = part['message']['content']
+        if content:
+            state['text'].append(content)
+            if state['object'] is None:
+                state['object'] = state['scanner'].feed(content)
+            else:
+                state['trailing'] += 1
+                if content.strip() or state['trailing'] > JSON_TRAILING_CHUNKS:
+                    # Only the streamed chunks are known when cut off, about one token each
+                    return {'eval_count': len(state['text']), 'early_stop': True}
+        if part.get('done'):
+            return part
+        return None
+
+    def _finish_json(self, stage, model, state, response) -> str:
+        if isinstance(response, dict) and response.get('early_stop'):
+            metrics.incr(f'{stage}.early_stops')
+        metrics.record_llm(stage, response, model)
+        return state['object'] or ''.join(state['text']).strip()
+
+    def embed_sync(self, texts: List[str], model: str, stage: str = 'embed') -> List[List[float]]:
+        """Blocking batch request to Ollama's embed endpoint, one vector per text"""
+        with self._sync_slot(model) as endpoint, metrics.span(stage):
+            response = endpoint.sync_client.embed(model=model, input=texts)
+        metrics.record_llm(stage, response, model)
+        return response['embeddings']
+
+    async def embed(self, texts: List[str], model: str, stage: str = 'embed') -> List[List[float]]:
+        """Batch embedding request sharing the chat concurrency limit and retry policy"""
+        async def call():
+            async with self._slot(model) as endpoint:
+                with metrics.span(stage):
+                    response = await asyncio.wait_for(
+                        endpoint.client.embed(model=model, input=texts), timeout=self.timeout)
+            metrics.record_llm(stage, response, model)
+            return response['embeddings']
+
+        return await self._retrying(stage, call)
+
+    async def chat_text(self, prompt: str, model: Optional[str] = None, **kwargs) -> str:
+        response = await self.chat(prompt, model=model, **kwargs)
+        return response['message']['content'].strip()
+
+    async def stream(self, prompt: str, model: Optional[str] = None,
+                     on_token: Optional[Callable[[str], Any]] = None) -> str:
+        """Stream a chat response, passing each chunk to on_token, and return the full text"""
+        full_response = ""
+        async with self._slot(model or self.model) as endpoint:
+            async for part in await endpoint.client.chat(
+                model=model or self.model,
+                messages=[{'role': 'user', 'content': prompt}],
+                stream=True
+            ):
+                content = part['message']['content']
+                if content:
+                    full_response += content
+                    if on_token:
+                        on_token(content)
+        return full_response
+
+    async def map(self, fn: Callable[[Any], Awaitable[Any]], items: Iterable) -> List[Any]:
+        """Apply an async function to every item concurrently, preserving order
+
+        Concurrency is bounded by the endpoint slots inside chat(), so it is
+        safe to schedule every item at once.
+        """
+        return await asyncio.gather(*(fn(item) for item in items))
+
+    async def _retrying(self, stage: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Run call(), retrying timeouts and transient server errors with exponential backoff"""
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not self._is_retryable(e):
+                    raise
+                metrics.incr(f'{stage}.retries')
+                await asyncio.sleep(min(2 ** (attempt - 1), 10))
+
+    def _is_retryable(self, exception: Exception) -> bool:
+        if isinstance(exception, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+            return True
+        if isinstance(exception, ollama.ResponseError):
+            return exception.status_code in RETRYABLE_STATUSES
+        return False
@@ -1,19 +1,77 @@
-import ollama
-import json
-import asyncio
+from tools.llm_engine import LLMEngine
+from tools.metrics import metrics
+from tools.threads import chunk_messages, normalize_subject, render_messages
+from tools.body_text import prompt_text
+from tools.model_cascade import ModelCascade, DEFAULT_ESCALATE_BELOW, pop_confidence
+from tools.structured_output import SchemaError, parse_structured, with_properties
+
+# Bump whenever the classification prompt changes so cached results are invalidated
+PROMPT_VERSION = "3"
+ANALYSIS_PROMPT_VERSION = "3"
+
+FALLBACK_CLASSIFICATION = {
+    "category": "Uncategorized",
+    "importance_score": 0.5,
+    "requires_action": False,
+    "priority_level": "Low",
+    "suggested_action": None,
+    "deadline": None
+}
+
+CATEGORIES = ['Work', 'Personal', 'Finance', 'Shopping', 'Social', 'News', 'Spam']
+PRIORITY_LEVELS = ['Low', 'Medium', 'High', 'Urgent']
+
+# Passed to Ollama as `format` so generation is constrained to it, and used to
+# coerce and validate whatever comes back
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": CATEGORIES},
+        "importance_score": {"type": "number", "minimum": 0, "maximum": 1},
+        "requires_action": {"type": "boolean"},
+        "priority_level": {"type": "string", "enum": PRIORITY_LEVELS},
+        "suggested_action": {"type": ["string", "null"]},
+        "deadline": {"type": ["string", "null"]},
+    },
+    "required": ["category", "importance_score", "requires_action", "priority_level",
+                 "suggested_action", "deadline"],
+}
+ANALYSIS_SCHEMA = with_properties(CLASSIFICATION_SCHEMA, summary={"type": "string"})
+
+# Rejected answers are re-asked once with the validation errors before falling back
+MAX_REPAIRS = 1
 
 class MailClassifier:
-    def __init__(self, model_name="deepseek-r1:8b"):
+    def __init__(self, model_name="deepseek-r1:8b", engine=None, rules=None, rule_threshold=0.8,
+                 fast_model=None, escalate_below=DEFAULT_ESCALATE_BELOW, max_repairs=MAX_REPAIRS):
         self.model = model_name
+        # Results of a cascade depend on the fast model too, so it is part of the cache key
+        cascade = f"+{fast_model}" if fast_model else ""
+        self.prompt_version = f"{PROMPT_VERSION}{cascade}"
+        self.analysis_prompt_version = f"analysis-{ANALYSIS_PROMPT_VERSION}{cascade}"
+        self.engine = engine or LLMEngine(model_name)
+        # Optional RuleClassifier tier; only results below rule_threshold reach the model
+        self.rules = rules
+        self.rule_threshold = rule_threshold
+        # Optional small-model tier; only doubtful or invalid answers reach model_name
+        self.cascade = ModelCascade(self.engine, model_name, fast_model, escalate_below)
+        self.max_repairs = max_repairs
 
-    def classify_email(self, email_data):
-        """Classify an email and determine its importance and required actions"""
-        prompt = f"""
+    def pre_classify(self, email_data):
+        """Run the rule tier, returning its result or None when the model is needed"""
+        if self.rules is None:
+            return None
+        with metrics.span('rules'):
+            return self.rules.pre_classify(email_data, self.rule_threshold)
+
+    def build_prompt(self, email_data):
+        """Build the classification prompt for an email"""
+        return f"""
         Analyze this email and provide classification details in JSON format:
 
         Subject: {email_data['subject']}
         From: {email_data['sender']}
-        Content: {email_data['body'][:2000]}
+        Content: {prompt_text(email_data)}
 
         Provide a JSON response with the following structure:
         {{
@@ -26,42 +84,159 @@ class MailClassifier:
         }}
         """
 
+    def build_analysis_prompt(self, email_data):
+        """Build the combined classification + summary prompt for an email"""
+        return f"""
+        Analyze this email and respond with a single JSON object:
+
+        Subject: {email_data['subject']}
+        From: {email_data['sender']}
+        Content: {prompt_text(email_data)}
+
+        Use exactly these keys:
+        {{
+            "category": "one of [Work, Personal, Finance, Shopping, Social, News, Spam]",
+            "importance_score": "float between 0 and 1",
+            "requires_action": "boolean",
+            "priority_level": "one of [Low, Medium, High, Urgent]",
+            "suggested_action": "string or null if no action needed",
+            "deadline": "date string or null if no deadline",
+            "summary": "concise summary of the main points, required actions, key dates and important details"
+        }}
+        """
+
+    def build_thread_prompt(self, subject, previous_summary, messages):
+        """Build the rolling thread prompt: earlier summary plus the new text of each new message"""
+        return f"""
+        Analyze this email conversation and respond with a single JSON object:
+
+        Thread: {normalize_subject(subject)}
+        Summary of earlier messages: {previous_summary or 'None, these are the first messages'}
+
+        New messages, oldest first, with quoted replies and signatures removed:
+        {render_messages(messages)}
+
+        Classify the thread as it stands after the newest message. Use exactly these keys:
+        {{
+            "category": "one of [Work, Personal, Finance, Shopping, Social, News, Spam]",
+            "importance_score": "float between 0 and 1",
+            "requires_action": "boolean",
+            "priority_level": "one of [Low, Medium, High, Urgent]",
+            "suggested_action": "string or null if no action needed",
+            "deadline": "date string or null if no deadline",
+            "summary": "updated summary of the whole conversation: main points, decisions, open questions and required actions"
+        }}
+        """
+
+    def parse_response(self, response_text, schema=CLASSIFICATION_SCHEMA):
+        """Extract the classification JSON from a model response and coerce it into the schema
+
+        Raises SchemaError when the answer has no usable object or a field
+        cannot be coerced (e.g. an unknown category).
+        """
+        result = parse_structured(response_text, schema)
+        if 'summary' in result and not result['summary']:
+            raise SchemaError(["summary is empty"])
+        return result
+
+    def _ask_sync(self, prompt, stage, schema):
+        return self.cascade.ask_sync(prompt, stage, lambda text: self.parse_response(text, schema),
+                                     self._fast_parser(schema), fast_format=self._fast_schema(schema),
+                                     retries=self.max_repairs, format=schema)
+
+    async def _ask(self, prompt, stage, schema):
+        return await self.cascade.ask(prompt, stage, lambda text: self.parse_response(text, schema),
+                                      self._fast_parser(schema), fast_format=self._fast_schema(schema),
+                                      retries=self.max_repairs, format=schema)
+
+    def _fast_schema(self, schema):
+        return with_properties(schema, confidence={"type": "number", "minimum": 0, "maximum": 1})
+
+    def _fast_parser(self, schema):
+        """Parse and validate a fast-tier answer into (classification, confidence)"""
+        fast_schema = self._fast_schema(schema)
+        return lambda text: pop_confidence(self.parse_response(text, fast_schema))
+
+    def _fallback(self, stage, error):
+        # Counted so silent quality loss shows up in the metrics, and never cached by the agent
+        print(f"{stage} error, using the fallback classification: {error}")
+        metrics.incr(f'{stage}.fallbacks')
+        return dict(FALLBACK_CLASSIFICATION)
+
+    def classify_email(self, email_data, use_rules=True):
+        """Classify an email and determine its importance and required actions"""
+        pre_classified = self.pre_classify(email_data) if use_rules else None
+        if pre_classified is not None:
+            return pre_classified
+        try:
+            with metrics.span('prompt.build'):
+                prompt = self.build_prompt(email_data)
+            return self._ask_sync(prompt, 'classify', CLASSIFICATION_SCHEMA)
+        except Exception as e:
+            return self._fallback('classify', e)
+
+    async def classify_email_async(self, email_data, use_rules=True):
+        """Async variant of classify_email that runs through the shared LLMEngine"""
+        pre_classified = self.pre_classify(email_data) if use_rules else None
+        if pre_classified is not None:
+            return pre_classified
+        try:
+            with metrics.span('prompt.build'):
+                prompt = self.build_prompt(email_data)
+            return await self._ask(prompt, 'classify', CLASSIFICATION_SCHEMA)
+        except Exception as e:
+            return self._fallback('classify', e)
+
+    def classify_and_summarize(self, email_data):
+        """Classify and summarize an email with a single JSON-constrained model call"""
+        try:
+            with metrics.span('prompt.build'):
+                prompt = self.build_analysis_prompt(email_data)
+            return self._ask_sync(prompt, 'analyze', ANALYSIS_SCHEMA)
+        except Exception as e:
+            return self._fallback('analyze', e)
+
+    async def classify_and_summarize_async(self, email_data):
+        """Async variant of classify_and_summarize"""
+        try:
+            with metrics.span('prompt.build'):
+                prompt = self.build_analysis_prompt(email_data)
+            return await self._ask(prompt, 'analyze', ANALYSIS_SCHEMA)
+        except Exception as e:
+            return self._fallback('analyze', e)
+
+    def analyze_thread(self, messages, previous_summary=None):
+        """Classify a thread and roll its summary forward over the new messages
+
+        Returns the classification of the thread plus an updated "summary". On
+        failure the fallback classification is returned without a summary.
+        """
+        subject = messages[0]['subject'] if messages else ''
+        result = None
+        try:
+            for chunk in chunk_messages(messages):
+                with metrics.span('prompt.build'):
+                    prompt = self.build_thread_prompt(subject, previous_summary, chunk)
+                result = self._ask_sync(prompt, 'analyze_thread', ANALYSIS_SCHEMA)
+                previous_summary = result.get('summary') or previous_summary
+            return result or dict(FALLBACK_CLASSIFICATION)
+        except Exception as e:
+            return self._fallback('analyze_thread', e)
+
+    async def analyze_thread_async(self, messages, previous_summary=None):
+        """Async variant of analyze_thread; chunks of one thread still run in order"""
+        subject = messages[0]['subject'] if messages else ''
+        result = None
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-            
-            # Extract JSON from response
-            response_text = response['message']['content'].strip()
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].split("```")[0]
-            else:
-                json_str = response_text
-            
-            classification = json.loads(json_str)
-            return classification
+            for chunk in chunk_messages(messages):
+                with metrics.span('prompt.build'):
+                    prompt = self.build_thread_prompt(subject, previous_summary, chunk)
+                result = await self._ask(prompt, 'analyze_thread', ANALYSIS_SCHEMA)
+                previous_summary = result.get('summary') or previous_summary
+            return result or dict(FALLBACK_CLASSIFICATION)
         except Exception as e:
-            print(f"Classification error: {e}")
-            return {
-                "category": "Uncategorized",
-                "importance_score": 0.5,
-                "requires_action": False,
-                "priority_level": "Low",
-                "suggested_action": None,
-                "deadline": None
-            }
+            return self._fallback('analyze_thread', e)
 
     async def _get_ollama_response(self, prompt):
         """Get response from Ollama"""
-        full_response = ""
-        async for part in ollama.chat(
-            model=self.model,
-            messages=[{'role': 'user', 'content': prompt}],
-            stream=True
-        ):
-            if 'content' in part:
-                full_response += part['content']
-        return full_response 
\ No newline at end of file
+        return await self.engine.stream(prompt, model=self.model)
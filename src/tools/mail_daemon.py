@@ -0,0 +1,182 @@
+import asyncio
+import contextlib
+import functools
+import signal
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+from tools.metrics import metrics
+from tools.threads import group_by_thread
+
+
+class MailDaemon:
+    """Long-running service that polls Gmail and feeds new mail to a pool of LLM workers
+
+    Each poll stores new messages and puts their IDs on a bounded queue, one
+    item per conversation. When the queue is full the poller waits for the
+    workers (backpressure). Once a poll has been drained, the digest,
+    important-email list and period summary are built together from the
+    stored results, at most once per report_interval. A conversation is
+    processed by one worker at a time, so its rolling summary is never
+    updated by two batches at once.
+
+    stop() (or SIGINT/SIGTERM) ends polling; workers finish the batch they are
+    on and exit. Queued but unprocessed messages stay unclassified in the store
+    and are picked up again on the next start.
+    """
+
+    def __init__(self, agent, hours: int = 24, poll_interval: float = 300, workers: Optional[int] = None,
+                 max_queue: int = 200, batch_size: int = 20, report_interval: float = 3600,
+                 on_report: Optional[Callable[[Dict], None]] = None):
+        self.agent = agent
+        self.hours = hours
+        self.poll_interval = poll_interval
+        # More workers than parallel model slots only adds queueing inside the engine
+        self.workers = workers or agent.engine.concurrency
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.processed = 0
+        self.last_report = None
+        self._queue = None
+        self._stopping = None
+        self._last_report_at = None
+        # Set when a batch was processed since the last report (and for the first report)
+        self._dirty = True
+        # Thread key -> (lock, number of workers using or waiting for it)
+        self._thread_locks = {}
+
+    async def run(self):
+        """Poll, process and report until stop() is called"""
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._stopping = asyncio.Event()
+        self._install_signal_handlers()
+        workers = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"\nMail daemon started: polling every {self.poll_interval:g}s with {self.workers} workers")
+        try:
+            # Resume messages stored by an earlier run that never got classified
+            since = datetime.now() - timedelta(hours=self.hours)
+            await self._enqueue([email['message_id'] for email in
+                                 self.agent.store.iter_query(since=since, classified=False)])
+            while not self._stopping.is_set():
+                await self._poll_once()
+                await self._wait_or_stop(asyncio.sleep(self.poll_interval))
+        finally:
+            self._stopping.set()
+            await asyncio.gather(*workers, return_exceptions=True)
+            print(f"\nMail daemon stopped after processing {self.processed} emails "
+                  f"({self._queue.qsize()} threads left queued)")
+
+    def stop(self):
+        """Request a graceful shutdown"""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def _poll_once(self):
+        loop = asyncio.get_running_loop()
+        try:
+            new_ids = await loop.run_in_executor(
+                None, functools.partial(self.agent.fetcher.poll, time_range_hours=self.hours))
+        except Exception as e:
+            print(f"Poll failed: {e}")
+            return
+        metrics.incr('daemon.new_messages', len(new_ids))
+        await self._enqueue(new_ids)
+        # Report only from fully processed state
+        if not await self._wait_or_stop(self._queue.join()):
+            return
+        if self._dirty and self._report_due():
+            await self._report()
+
+    async def _enqueue(self, message_ids: List[str]):
+        """Queue message IDs grouped by conversation, waiting while the queue is full"""
+        if not message_ids:
+            return
+        emails = self.agent.store.get_many(message_ids)
+        for key, messages in group_by_thread(emails).items():
+            item = (key, [email['message_id'] for email in messages])
+            if not await self._wait_or_stop(self._queue.put(item)):
+                return
+
+    async def _worker(self, index: int):
+        while True:
+            get = asyncio.ensure_future(self._queue.get())
+            if not await self._wait_or_stop(get):
+                return
+            items = [get.result()]
+            size = len(items[0][1])
+            while size < self.batch_size and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+                size += len(items[-1][1])
+            try:
+                async with contextlib.AsyncExitStack() as stack:
+                    # Locks are taken in sorted order so two workers can never wait on each other
+                    for key in sorted({key for key, _ in items}):
+                        await stack.enter_async_context(self._thread_lock(key))
+                    await self._process([mid for _, message_ids in items for mid in message_ids])
+            except Exception as e:
+                print(f"Worker {index} failed on a batch of {size} emails: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    async def _process(self, message_ids: List[str]):
+        emails = self.agent.store.get_many(message_ids)
+        with metrics.span('daemon.batch'):
+            await self.agent.classify_emails_async(emails, summarize=True)
+            with metrics.span('cache.save'):
+                self.agent.store.upsert_many(emails)
+        self.processed += len(emails)
+        self._dirty = True
+
+    @contextlib.asynccontextmanager
+    async def _thread_lock(self, key: str):
+        """Hold the conversation's lock; the lock is dropped once no worker needs it"""
+        lock, users = self._thread_locks.get(key) or (asyncio.Lock(), 0)
+        self._thread_locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._thread_locks[key]
+            if users == 1:
+                del self._thread_locks[key]
+            else:
+                self._thread_locks[key] = (lock, users - 1)
+
+    def _report_due(self) -> bool:
+        return self._last_report_at is None or time.monotonic() - self._last_report_at >= self.report_interval
+
+    async def _report(self):
+        # Cleared first so a batch finishing during the report marks the next one due
+        self._dirty = False
+        try:
+            self.last_report = await self.agent.generate_reports_async(self.hours)
+        except Exception as e:
+            print(f"Report generation failed: {e}")
+            self._dirty = True
+            return
+        self._last_report_at = time.monotonic()
+        if self.on_report:
+            self.on_report(self.last_report)
+
+    async def _wait_or_stop(self, awaitable: Awaitable) -> bool:
+        """Await until done or until stop() is requested; returns False if stopped first"""
+        task = asyncio.ensure_future(awaitable)
+        stopper = asyncio.ensure_future(self._stopping.wait())
+        done, _ = await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if task in done:
+            return True
+        task.cancel()
+        return False
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows event loops do not support signal handlers
+                pass
@@ -0,0 +1,403 @@
+import sqlite3
+import json
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from datetime import datetime
+from typing import Callable, List, Dict, Iterable, Iterator, Optional
+from tools.blob_store import BlobStore
+from tools.email_record import EmailRecord, FIELDS, IMPORTANCE_THRESHOLD
+
+# Fields with a typed conversion; a legacy value that does not convert is dropped on import
+LEGACY_TYPED_FIELDS = ('date', 'importance_score', 'requires_action')
+
+# Columns stored natively so they can be indexed and filtered in SQL; any other
+# email field (summary, suggested_action, deadline, ...) lives in the extra JSON column
+CLASSIFICATION_FIELDS = ('category', 'importance_score', 'requires_action', 'priority_level')
+CORE_FIELDS = ('message_id', 'thread_id', 'date', 'subject', 'sender', 'body', 'body_ref',
+               'labels') + CLASSIFICATION_FIELDS
+# Record fields kept in the extra JSON column
+EXTRA_FIELDS = tuple(name for name in FIELDS if name not in CORE_FIELDS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    date TEXT,
+    date_ts REAL,
+    subject TEXT,
+    sender TEXT,
+    body TEXT,
+    body_ref TEXT,
+    labels TEXT,
+    category TEXT,
+    importance_score REAL,
+    requires_action INTEGER,
+    priority_level TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date_ts);
+CREATE INDEX IF NOT EXISTS idx_messages_category ON messages(category, date_ts);
+CREATE INDEX IF NOT EXISTS idx_messages_importance ON messages(importance_score);
+CREATE INDEX IF NOT EXISTS idx_messages_requires_action ON messages(requires_action);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    subject TEXT,
+    summary TEXT,
+    message_ids TEXT NOT NULL DEFAULT '[]',
+    last_date_ts REAL,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Existing values win over NULLs so a metadata-only refetch never wipes a classification
+UPSERT_SQL = """
+INSERT INTO messages (message_id, thread_id, date, date_ts, subject, sender, body, body_ref, labels,
+                      category, importance_score, requires_action, priority_level, extra)
+VALUES (:message_id, :thread_id, :date, :date_ts, :subject, :sender, :body, :body_ref, :labels,
+        :category, :importance_score, :requires_action, :priority_level, :extra)
+ON CONFLICT(message_id) DO UPDATE SET
+    thread_id = COALESCE(excluded.thread_id, messages.thread_id),
+    date = COALESCE(excluded.date, messages.date),
+    date_ts = COALESCE(excluded.date_ts, messages.date_ts),
+    subject = COALESCE(excluded.subject, messages.subject),
+    sender = COALESCE(excluded.sender, messages.sender),
+    -- A body moved to the blob store no longer needs the inline copy of older rows
+    body = CASE WHEN excluded.body_ref IS NOT NULL THEN NULL ELSE COALESCE(excluded.body, messages.body) END,
+    body_ref = COALESCE(excluded.body_ref, messages.body_ref),
+    labels = COALESCE(excluded.labels, messages.labels),
+    category = COALESCE(excluded.category, messages.category),
+    importance_score = COALESCE(excluded.importance_score, messages.importance_score),
+    requires_action = COALESCE(excluded.requires_action, messages.requires_action),
+    priority_level = COALESCE(excluded.priority_level, messages.priority_level),
+    extra = json_patch(messages.extra, excluded.extra)
+"""
+
+
+class MailStore:
+    """SQLite (WAL) message store keyed by message_id
+
+    Message bodies live in a content-addressed BlobStore next to the database
+    and are only read when an email's body is accessed. Emails are returned as
+    EmailRecords; plain dicts are accepted wherever emails are written.
+    """
+
+    def __init__(self, db_path: str = 'mail_store.db', blob_dir: Optional[str] = None):
+        self.db_path = db_path
+        # An in-memory store's blobs go to a temporary directory, removed on close() or garbage collection
+        self._remove_temp_blobs = None
+        if blob_dir is None and db_path == ':memory:':
+            blob_dir = tempfile.mkdtemp(prefix='mail_blobs_')
+            self._remove_temp_blobs = weakref.finalize(self, shutil.rmtree, blob_dir, True)
+        elif blob_dir is None:
+            blob_dir = os.path.splitext(db_path)[0] + '_blobs'
+        self.blobs = BlobStore(blob_dir)
+        # Called with the deleted message IDs, so derived data (e.g. embeddings) can follow
+        self.on_delete: List[Callable[[List[str]], None]] = []
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Bring stores created by older versions up to the current schema"""
+        columns = {row['name'] for row in self.conn.execute('PRAGMA table_info(messages)')}
+        with self.conn:
+            if 'thread_id' not in columns:
+                self.conn.execute('ALTER TABLE messages ADD COLUMN thread_id TEXT')
+            # Rows written before the blob store keep their inline body until rewritten
+            if 'body_ref' not in columns:
+                self.conn.execute('ALTER TABLE messages ADD COLUMN body_ref TEXT')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id, date_ts)')
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+        if self._remove_temp_blobs is not None:
+            self._remove_temp_blobs()
+
+    def upsert(self, email_data: Dict):
+        """Insert or update a single email"""
+        self.upsert_many([email_data])
+
+    def upsert_many(self, emails: Iterable[Dict]):
+        """Insert or update emails in a single transaction"""
+        rows = [self._to_row(email_data) for email_data in emails]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(UPSERT_SQL, rows)
+
+    def get(self, message_id: str) -> Optional[EmailRecord]:
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT * FROM messages WHERE message_id = ?', (message_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def get_many(self, message_ids: Iterable[str]) -> List[EmailRecord]:
+        """Return the stored emails among message_ids, in the given order"""
+        return list(self._iter_rows(list(message_ids)))
+
+    def existing_ids(self, message_ids: Iterable[str]) -> set:
+        """Return the subset of message_ids already in the store"""
+        message_ids = list(message_ids)
+        found = set()
+        with self._lock:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(row[0] for row in self.conn.execute(
+                    f'SELECT message_id FROM messages WHERE message_id IN ({placeholders})', chunk))
+        return found
+
+    def delete(self, message_ids: Iterable[str]):
+        message_ids = list(message_ids)
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM messages WHERE message_id = ?',
+                                  [(mid,) for mid in message_ids])
+        for callback in self.on_delete:
+            callback(message_ids)
+
+    def prune_blobs(self) -> int:
+        """Delete blobs no longer referenced by any message; returns how many were removed"""
+        with self._lock:
+            referenced = {row[0] for row in self.conn.execute(
+                'SELECT body_ref FROM messages WHERE body_ref IS NOT NULL')}
+            referenced.update(row[0] for row in self.conn.execute(
+                "SELECT json_extract(value, '$.blob') FROM messages, json_each(messages.extra, '$.attachments') "
+                "WHERE json_extract(value, '$.blob') IS NOT NULL"))
+        removed = 0
+        for key in self.blobs.keys():
+            if key not in referenced:
+                self.blobs.delete(key)
+                removed += 1
+        return removed
+
+    def query(self, **filters) -> List[EmailRecord]:
+        """Return emails matching the filters, newest first (see iter_query)"""
+        return list(self.iter_query(**filters))
+
+    def iter_query(self, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   category: Optional[str] = None, min_importance: Optional[float] = None,
+                   requires_action: Optional[bool] = None, important: bool = False,
+                   classified: Optional[bool] = None, thread_id: Optional[str] = None,
+                   limit: Optional[int] = None) -> Iterator[EmailRecord]:
+        """Yield emails matching the filters, newest first, without loading the whole table
+
+        important=True matches emails with importance_score above the threshold
+        or requiring action, mirroring the agent's notion of an important email.
+        """
+        # Only the matching IDs are materialized; rows are read in short chunks so no
+        # read transaction stays open while the caller writes between iterations
+        message_ids = self.message_ids(since=since, until=until, category=category,
+                                       min_importance=min_importance, requires_action=requires_action,
+                                       important=important, classified=classified, thread_id=thread_id,
+                                       limit=limit)
+        yield from self._iter_rows(message_ids)
+
+    def message_ids(self, limit: Optional[int] = None, **filters) -> List[str]:
+        """IDs of the emails matching the same filters as iter_query, newest first"""
+        sql, params = self._where(**filters)
+        sql = f'SELECT message_id FROM messages{sql} ORDER BY date_ts DESC'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            return [row[0] for row in self.conn.execute(sql, params)]
+
+    def _iter_rows(self, message_ids: List[str]) -> Iterator[EmailRecord]:
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            with self._lock:
+                rows = {row['message_id']: row for row in self.conn.execute(
+                    f'SELECT * FROM messages WHERE message_id IN ({placeholders})', chunk)}
+            for message_id in chunk:
+                if message_id in rows:
+                    yield self._from_row(rows[message_id])
+
+    def count(self, **filters) -> int:
+        """Count emails matching the same filters as iter_query"""
+        sql, params = self._where(**filters)
+        with self._lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM messages{sql}', params).fetchone()[0]
+
+    def get_threads(self, thread_ids: Iterable[str]) -> Dict[str, Dict]:
+        """Return the stored rolling state of each known thread, keyed by thread_id"""
+        thread_ids = list(thread_ids)
+        threads = {}
+        with self._lock:
+            for start in range(0, len(thread_ids), 500):
+                chunk = thread_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self.conn.execute(f'SELECT * FROM threads WHERE thread_id IN ({placeholders})', chunk):
+                    threads[row['thread_id']] = {
+                        'thread_id': row['thread_id'],
+                        'subject': row['subject'] or '',
+                        'summary': row['summary'],
+                        'message_ids': json.loads(row['message_ids']),
+                        'last_date_ts': row['last_date_ts'],
+                    }
+        return threads
+
+    def upsert_threads(self, threads: Iterable[Dict]):
+        """Insert or replace the rolling state of threads in a single transaction"""
+        now = datetime.now().isoformat()
+        rows = [(t['thread_id'], t.get('subject'), t.get('summary'), json.dumps(t.get('message_ids', [])),
+                 t.get('last_date_ts'), now) for t in threads]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO threads (thread_id, subject, summary, message_ids, '
+                                  'last_date_ts, updated_at) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def import_json(self, path: str) -> int:
+        """Import a legacy JSON cache file (emails_cache.json / classified_emails.json)
+
+        Rows are converted one by one: a value that does not fit its field
+        (e.g. an importance_score of "high") is dropped, and a row that still
+        cannot be stored is skipped, so one bad row never blocks the migration.
+        Returns the number of emails imported.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            emails = json.load(f)
+        rows, skipped = [], 0
+        for email_data in emails:
+            row = self._legacy_row(email_data) if isinstance(email_data, dict) and email_data.get('message_id') else None
+            if row is None:
+                skipped += 1
+            else:
+                rows.append(row)
+        with self._lock, self.conn:
+            self.conn.executemany(UPSERT_SQL, rows)
+        if skipped:
+            print(f"Skipped {skipped} unreadable emails in {path}")
+        return len(rows)
+
+    def _legacy_row(self, email_data: Dict) -> Optional[Dict]:
+        try:
+            return self._to_row(email_data)
+        except (TypeError, ValueError):
+            pass
+        cleaned = dict(email_data)
+        for field in LEGACY_TYPED_FIELDS:
+            try:
+                EmailRecord(**{field: cleaned.get(field)})
+            except (TypeError, ValueError):
+                cleaned.pop(field, None)
+        try:
+            return self._to_row(cleaned)
+        except (TypeError, ValueError):
+            return None
+
+    def migrate_json_files(self, paths: Iterable[str]):
+        """Import legacy JSON caches once; later calls are no-ops"""
+        for path in paths:
+            key = f'migrated:{os.path.abspath(path)}'
+            if not os.path.exists(path) or self.get_meta(key):
+                continue
+            try:
+                count = self.import_json(path)
+                self.set_meta(key, datetime.now().isoformat())
+                print(f"\nMigrated {count} emails from {path} into {self.db_path}")
+            except Exception as e:
+                print(f"Error migrating {path}: {e}")
+
+    def _where(self, since=None, until=None, category=None, min_importance=None,
+               requires_action=None, important=False, classified=None, thread_id=None):
+        clauses, params = [], []
+        if since is not None:
+            clauses.append('date_ts >= ?')
+            params.append(self._timestamp(since))
+        if until is not None:
+            clauses.append('date_ts < ?')
+            params.append(self._timestamp(until))
+        if category is not None:
+            clauses.append('category = ?')
+            params.append(category)
+        if min_importance is not None:
+            clauses.append('importance_score >= ?')
+            params.append(min_importance)
+        if requires_action is not None:
+            clauses.append('requires_action = ?')
+            params.append(int(requires_action))
+        if important:
+            clauses.append('(importance_score > ? OR requires_action = 1)')
+            params.append(IMPORTANCE_THRESHOLD)
+        if classified is not None:
+            clauses.append('category IS NOT NULL' if classified else 'category IS NULL')
+        if thread_id is not None:
+            clauses.append('thread_id = ?')
+            params.append(thread_id)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def _timestamp(self, value) -> Optional[float]:
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value.timestamp()
+
+    def _to_row(self, email_data: Dict) -> Dict:
+        record = EmailRecord.of(email_data)
+        # Never trigger a lazy load here: an unloaded body is already in the blob store
+        body = record.loaded_body
+        body_ref = record.body_ref
+        if body and not body_ref:
+            body_ref = self.blobs.put_text(body)
+            email_data['body_ref'] = body_ref
+        extra = {name: getattr(record, name) for name in EXTRA_FIELDS if getattr(record, name) is not None}
+        extra.update(record.extra)
+        return {
+            'message_id': record.message_id,
+            'thread_id': record.thread_id,
+            'date': record.date.isoformat() if record.date else None,
+            'date_ts': record.date.timestamp() if record.date else None,
+            'subject': record.subject,
+            'sender': record.sender,
+            'body': None if body_ref else body,
+            'body_ref': body_ref,
+            'labels': json.dumps(record.labels) if record.labels is not None else None,
+            'category': record.category,
+            'importance_score': record.importance_score,
+            'requires_action': int(record.requires_action) if record.requires_action is not None else None,
+            'priority_level': record.priority_level,
+            'extra': json.dumps(extra, ensure_ascii=False, default=str),
+        }
+
+    def _from_row(self, row) -> EmailRecord:
+        record = EmailRecord(blobs=self.blobs)
+        record.message_id = row['message_id']
+        record.thread_id = row['thread_id']
+        record.subject = row['subject'] or ''
+        record.sender = row['sender'] or ''
+        record.date = row['date']
+        record.labels = json.loads(row['labels']) if row['labels'] else []
+        # Unset classification fields stay None, so email.get(field, default) keeps working
+        record.category = row['category']
+        record.importance_score = row['importance_score']
+        record.requires_action = row['requires_action']
+        record.priority_level = row['priority_level']
+        if row['body_ref']:
+            record.body_ref = row['body_ref']
+        else:
+            record.body = row['body'] or ''
+        record.update(json.loads(row['extra']))
+        return record
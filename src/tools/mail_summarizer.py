@@ -1,23 +1,58 @@
-import ollama
-import json
 from datetime import datetime
 import os
+from tools.llm_engine import LLMEngine
+from tools.model_cascade import ModelCascade, DEFAULT_ESCALATE_BELOW, pop_confidence
+from tools.structured_output import parse_structured
+from tools.metrics import metrics
+from tools.digest_writer import DigestWriter
+from tools.digest_renderer import DEFAULT_KEEP_DAYS, IncrementalDigest, build_digest, render
+from tools.body_text import estimate_tokens, prompt_text
+from tools.email_record import EmailBatch
+from tools.threads import (chunk_messages, group_by_thread, normalize_subject, render_messages,
+                           thread_representative)
+
+# Token budget for the email data in one period/chunk prompt, leaving room for
+# the instructions and the answer inside an 8k context
+DEFAULT_MAX_PROMPT_TOKENS = 5000
+
+# Fast-tier summaries come back as JSON so they can carry a confidence
+FAST_SUMMARY_FORMAT = """
+        Respond with a JSON object with the key "summary" holding the summary text.
+        """
+FAST_SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+    },
+    "required": ["summary", "confidence"],
+}
 
 class MailSummarizer:
-    def __init__(self, model_name="deepseek-r1:8b"):
+    def __init__(self, model_name="deepseek-r1:8b", engine=None,
+                 token_estimator=None, max_prompt_tokens=DEFAULT_MAX_PROMPT_TOKENS,
+                 digest_folder="mail_digests", fast_model=None, escalate_below=DEFAULT_ESCALATE_BELOW,
+                 digest_formats=('md',), keep_digest_days=DEFAULT_KEEP_DAYS):
         self.model = model_name
-        self.digest_folder = "mail_digests"
+        self.engine = engine or LLMEngine(model_name)
+        # Email and thread summaries try fast_model first; period reports always use model_name
+        self.cascade = ModelCascade(self.engine, model_name, fast_model, escalate_below)
+        self.estimate_tokens = token_estimator or estimate_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.digest_folder = digest_folder
         if not os.path.exists(self.digest_folder):
             os.makedirs(self.digest_folder)
+        # Stable-path digest that re-renders only the sections whose emails changed
+        self.digest = IncrementalDigest(self.digest_folder, digest_formats, keep_digest_days)
 
-    def summarize_email(self, email_data):
-        """Summarize a single email using Ollama"""
-        prompt = f"""
+    def build_email_prompt(self, email_data):
+        """Build the single-email summary prompt"""
+        return f"""
         Summarize this email concisely:
 
         Subject: {email_data['subject']}
         From: {email_data['sender']}
-        Content: {email_data['body'][:2000]}
+        Content: {prompt_text(email_data)}
 
         Provide a brief summary that captures:
         1. Main points
@@ -26,39 +61,157 @@ class MailSummarizer:
         4. Important details
         """
 
+    def parse_fast_summary(self, text):
+        """(summary, confidence) from a fast-tier JSON answer; raises when there is no summary"""
+        result, confidence = pop_confidence(parse_structured(text, FAST_SUMMARY_SCHEMA))
+        summary = result['summary']
+        if not summary:
+            raise ValueError("summary is missing")
+        return summary, confidence
+
+    def _summarize(self, prompt, stage):
+        return self.cascade.ask_sync(prompt, stage, str.strip, self.parse_fast_summary,
+                                     fast_instructions=FAST_SUMMARY_FORMAT, fast_format=FAST_SUMMARY_SCHEMA)
+
+    async def _summarize_async(self, prompt, stage):
+        return await self.cascade.ask(prompt, stage, str.strip, self.parse_fast_summary,
+                                      fast_instructions=FAST_SUMMARY_FORMAT, fast_format=FAST_SUMMARY_SCHEMA)
+
+    def summarize_email(self, email_data):
+        """Summarize a single email using Ollama"""
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-            return response['message']['content'].strip()
+            return self._summarize(self.build_email_prompt(email_data), 'summarize')
         except Exception as e:
             print(f"Summarization error: {e}")
             return f"Error summarizing email: {email_data['subject']}"
 
-    def summarize_time_period(self, emails, hours=24):
-        """Summarize emails from the past N hours"""
-        if not emails:
-            return "No emails to summarize."
+    async def summarize_email_async(self, email_data):
+        """Async variant of summarize_email that runs through the shared LLMEngine"""
+        try:
+            return await self._summarize_async(self.build_email_prompt(email_data), 'summarize')
+        except Exception as e:
+            print(f"Summarization error: {e}")
+            return f"Error summarizing email: {email_data['subject']}"
+
+    def build_thread_prompt(self, subject, previous_summary, messages):
+        """Build the rolling thread summary prompt from the earlier summary and the new messages"""
+        return f"""
+        Update the summary of this email conversation.
+
+        Thread: {normalize_subject(subject)}
+        Summary so far: {previous_summary or 'None, these are the first messages'}
+
+        New messages, oldest first, with quoted replies and signatures removed:
+        {render_messages(messages)}
+
+        Write one concise summary of the whole conversation covering main points,
+        decisions, open questions, required actions and key dates.
+        """
+
+    def summarize_thread(self, messages, previous_summary=None):
+        """Roll a thread summary forward over its new messages (oldest first)"""
+        subject = messages[0]['subject'] if messages else ''
+        try:
+            for chunk in chunk_messages(messages):
+                previous_summary = self._summarize(self.build_thread_prompt(subject, previous_summary, chunk),
+                                                   'summarize_thread')
+            return previous_summary
+        except Exception as e:
+            print(f"Thread summarization error: {e}")
+            return None
+
+    async def summarize_thread_async(self, messages, previous_summary=None):
+        """Async variant of summarize_thread"""
+        subject = messages[0]['subject'] if messages else ''
+        try:
+            for chunk in chunk_messages(messages):
+                previous_summary = await self._summarize_async(
+                    self.build_thread_prompt(subject, previous_summary, chunk), 'summarize_thread')
+            return previous_summary
+        except Exception as e:
+            print(f"Thread summarization error: {e}")
+            return None
+
+    def _collapse_threads(self, emails):
+        """One entry per thread that has a rolling summary; other emails are kept as they are"""
+        entries = []
+        for messages in group_by_thread(emails).values():
+            if messages[-1].get('thread_summary'):
+                entries.append(thread_representative(messages))
+            else:
+                entries.extend(messages)
+        return entries
+
+    def _compact_line(self, email, summary):
+        """One-line, whitespace-free rendering of an email for period prompts"""
+        flag = '|ACTION' if email.get('requires_action', False) else ''
+        summary = ' '.join(str(summary).split())
+        return (f"[{email.get('category', 'Uncategorized')}|{email.get('importance_score', 0.5)}{flag}] "
+                f"{email['subject']} — {email['sender']}: {summary}")
+
+    def _period_overview(self, emails):
+        """Counts computed locally so the model never has to tally them"""
+        batch = EmailBatch(emails)
+        breakdown = ', '.join(f"{category}: {count}" for category, count in batch.category_counts().items())
+        return (f"Total emails: {len(batch)}; requiring action: {int(batch.requires_action.sum())}; "
+                f"by category: {breakdown}")
+
+    def _initial_chunks(self, emails, summaries):
+        """Group compact lines by category (most important first) and pack them into chunks"""
+        batch = EmailBatch(emails)
+        return self._pack([self._compact_line(batch.records[i], summaries[i])
+                           for i in batch.order_by_category_and_importance()])
 
-        email_summaries = []
-        for email in emails:
-            summary = self.summarize_email(email)
-            email_summaries.append({
-                'subject': email['subject'],
-                'sender': email['sender'],
-                'summary': summary,
-                'category': email.get('category', 'Uncategorized'),
-                'importance': email.get('importance_score', 0.5),
-                'requires_action': email.get('requires_action', False)
-            })
-
-        # Create overall summary
-        prompt = f"""
-        Create a comprehensive summary report for the last {hours} hours of emails:
+    def _pack(self, items):
+        """Pack text items into chunks that fit the token budget"""
+        chunks, current, used = [], [], 0
+        for item in items:
+            item = self._fit(item)
+            tokens = self.estimate_tokens(item)
+            if current and used + tokens > self.max_prompt_tokens:
+                chunks.append('\n'.join(current))
+                current, used = [], 0
+            current.append(item)
+            used += tokens
+        if current:
+            chunks.append('\n'.join(current))
+        return chunks
+
+    def _fit(self, text):
+        """Truncate a single item so it can never exceed the budget on its own"""
+        tokens = self.estimate_tokens(text)
+        if tokens <= self.max_prompt_tokens:
+            return text
+        return text[:int(len(text) * self.max_prompt_tokens / tokens)]
+
+    def _next_level(self, chunks, partials):
+        """Pack partial summaries for the next reduce round, guaranteeing progress"""
+        packed = self._pack(partials)
+        if len(packed) >= len(chunks):
+            # Partials did not shrink; fall back to merging them pairwise, still within the budget
+            packed = [self._fit('\n'.join(partials[i:i + 2])) for i in range(0, len(partials), 2)]
+        return packed
+
+    def build_chunk_prompt(self, block, hours):
+        """Build the map/reduce prompt for one chunk of emails or partial reports"""
+        return f"""
+        Condense this part of the email report for the last {hours} hours.
+        Email lines look like: [category|importance|ACTION] subject — sender: summary
+
+        {block}
+
+        Keep key highlights, action items and time-sensitive items; drop routine details.
+        """
+
+    def build_period_prompt(self, block, overview, hours):
+        """Build the overall period summary prompt"""
+        return f"""
+        Create a comprehensive summary report for the last {hours} hours of emails.
+
+        {overview}
 
         Email Data:
-        {json.dumps(email_summaries, indent=2)}
+        {block}
 
         Provide a structured summary including:
         1. Total number of emails
@@ -68,95 +221,94 @@ class MailSummarizer:
         5. Time-sensitive items
         """
 
+    def _chat(self, prompt):
+        response = self.engine.chat_sync(prompt, model=self.model, stage='period_summary')
+        return response['message']['content'].strip()
+
+    def summarize_time_period(self, emails, hours=24):
+        """Summarize emails from the past N hours
+
+        Emails are packed into token-budgeted chunks; when they do not fit one
+        prompt, each chunk is summarized (map) and the partial summaries are
+        combined recursively (reduce) until a single prompt remains.
+        """
+        if not emails:
+            return "No emails to summarize."
+
+        # Threads with a rolling summary contribute one line instead of one per message
+        entries = self._collapse_threads(emails)
+        # Reuse summaries produced earlier (e.g. by the digest) instead of recomputing them
+        summaries = [entry.get('summary') or self.summarize_email(entry) for entry in entries]
+
         try:
-            response = ollama.chat(
-                model=self.model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-            return response['message']['content'].strip()
+            chunks = self._initial_chunks(entries, summaries)
+            while len(chunks) > 1:
+                partials = [self._chat(self.build_chunk_prompt(chunk, hours)) for chunk in chunks]
+                chunks = self._next_level(chunks, partials)
+            return self._chat(self.build_period_prompt(chunks[0], self._period_overview(emails), hours))
+        except Exception as e:
+            print(f"Period summarization error: {e}")
+            return f"Error creating period summary for the last {hours} hours"
+
+    async def summarize_time_period_async(self, emails, hours=24):
+        """Async variant of summarize_time_period; map steps run concurrently"""
+        if not emails:
+            return "No emails to summarize."
+
+        async def summary_for(email):
+            return email.get('summary') or await self.summarize_email_async(email)
+
+        entries = self._collapse_threads(emails)
+        summaries = await self.engine.map(summary_for, entries)
+
+        async def condense(chunk):
+            return await self.engine.chat_text(self.build_chunk_prompt(chunk, hours), model=self.model,
+                                               stage='period_summary')
+
+        try:
+            chunks = self._initial_chunks(entries, summaries)
+            while len(chunks) > 1:
+                partials = await self.engine.map(condense, chunks)
+                chunks = self._next_level(chunks, partials)
+            return await self.engine.chat_text(
+                self.build_period_prompt(chunks[0], self._period_overview(emails), hours), model=self.model,
+                stage='period_summary')
         except Exception as e:
             print(f"Period summarization error: {e}")
             return f"Error creating period summary for the last {hours} hours"
 
     async def _stream_ollama(self, prompt):
         """Stream response from Ollama"""
-        full_response = ""
-        async for part in ollama.chat(
-            model=self.model,
-            messages=[{'role': 'user', 'content': prompt}],
-            stream=True
-        ):
-            if 'content' in part:
-                full_response += part['content']
-                print(part['content'], end='', flush=True)  # Show streaming output
-        return full_response
+        # Show streaming output
+        return await self.engine.stream(
+            prompt, model=self.model, on_token=lambda token: print(token, end='', flush=True))
 
     def generate_daily_digest_markdown(self, emails, hours=24):
         """Generate a markdown file with a summary of all emails"""
         if not emails:
             return "No emails to summarize."
 
-        # Sort emails by category and importance
-        emails_by_category = {}
-        for email in emails:
-            category = email.get('category', 'Uncategorized')
-            if category not in emails_by_category:
-                emails_by_category[category] = []
-            emails_by_category[category].append(email)
-
-        # Create markdown content
+        # One entry per conversation, grouped by category, rendered from the shared digest model
         now = datetime.now()
-        markdown_content = f"""# Email Digest for {now.strftime('%Y-%m-%d')}
-
-## Overview
-- Total Emails: {len(emails)}
-- Time Period: Last {hours} hours
-- Categories Found: {', '.join(emails_by_category.keys())}
-
-## Important Highlights
-"""
-        # Add high priority and action required emails
-        important_emails = [e for e in emails if e.get('importance_score', 0) > 0.7 or e.get('requires_action', False)]
-        if important_emails:
-            markdown_content += "\n### Priority Items\n"
-            for email in important_emails:
-                markdown_content += f"""
-- **{email['subject']}**
-  - From: {email['sender']}
-  - Priority: {email.get('priority_level', 'Not specified')}
-  - Action Required: {email.get('requires_action', False)}
-  - Summary: {email.get('summary', 'No summary available')}
-"""
-
-        # Add category-wise breakdown
-        markdown_content += "\n## Category Breakdown\n"
-        for category, category_emails in emails_by_category.items():
-            markdown_content += f"\n### {category} ({len(category_emails)} emails)\n"
-            for email in category_emails:
-                markdown_content += f"""
-- **{email['subject']}**
-  - From: {email['sender']}
-  - Priority: {email.get('priority_level', 'Not specified')}
-  - Summary: {email.get('summary', 'No summary available')}
-"""
-
-        # Add action items section
-        action_items = [e for e in emails if e.get('requires_action', False)]
-        if action_items:
-            markdown_content += "\n## Action Items\n"
-            for email in action_items:
-                markdown_content += f"""
-- [ ] **{email['subject']}** from {email['sender']}
-  - Priority: {email.get('priority_level', 'Not specified')}
-  - Action: {email.get('suggested_action', 'Review required')}
-  - Deadline: {email.get('deadline', 'Not specified')}
-"""
+        markdown_content = render(build_digest(emails, hours, now), 'md')
 
         # Save the markdown file
         filename = f"mail_digest_{now.strftime('%Y%m%d_%H%M%S')}.md"
         filepath = os.path.join(self.digest_folder, filename)
-        with open(filepath, 'w', encoding='utf-8') as f:
+        with metrics.span('digest.write'), open(filepath, 'w', encoding='utf-8') as f:
             f.write(markdown_content)
 
         print(f"\nDaily digest saved to: {filepath}")
-        return markdown_content 
\ No newline at end of file
+        return markdown_content
+
+    def update_digest(self, emails, hours=24):
+        """Update the digest at its stable path, re-rendering only sections whose emails changed"""
+        if not emails:
+            return "No emails to summarize."
+        documents = self.digest.update(emails, hours)
+        print(f"\nDaily digest updated: {self.digest.path()}")
+        return documents['md']
+
+    def open_digest_stream(self, hours=24):
+        """Open a DigestWriter that appends emails to a digest file as they complete"""
+        return DigestWriter(self.digest_folder, hours)
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+# Ollama response fields captured for every model call
+LLM_FIELDS = ('prompt_eval_count', 'eval_count', 'total_duration', 'load_duration',
+              'prompt_eval_duration', 'eval_duration')
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, error=exc_type is not None)
+        return False
+
+
+class Metrics:
+    """Per-stage timing spans, counters and Ollama token statistics
+
+    Disabled by default: span() then returns a shared no-op context manager and
+    the other recording methods return after a single attribute check.
+    """
+
+    def __init__(self, enabled: bool = False, jsonl_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._jsonl = None
+        self.enabled = False
+        self.reset()
+        if enabled:
+            self.enable(jsonl_path)
+
+    def enable(self, jsonl_path: Optional[str] = None):
+        """Start recording; with jsonl_path every span and model call is also appended as a JSON line"""
+        with self._lock:
+            if jsonl_path and self._jsonl is None:
+                self._jsonl = open(jsonl_path, 'a', encoding='utf-8', buffering=1)
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            # stage -> [count, total_seconds, max_seconds, errors]
+            self.timings = {}
+            # stage -> {field: total}
+            self.llm = {}
+
+    def span(self, name: str):
+        """Time a block of code under the given stage name"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        if not self.enabled:
+            return
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = [0, 0.0, 0.0, 0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3] += int(error)
+            self._emit({'type': 'span', 'name': name, 'seconds': seconds, 'error': error})
+
+    def incr(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_llm(self, stage: str, response, model: Optional[str] = None):
+        """Capture eval/prompt token counts and durations from an Ollama response"""
+        if not self.enabled or response is None:
+            return
+        values = {field: response.get(field) or 0 for field in LLM_FIELDS}
+        with self._lock:
+            totals = self.llm.get(stage)
+            if totals is None:
+                totals = self.llm[stage] = dict.fromkeys(('calls',) + LLM_FIELDS, 0)
+            totals['calls'] += 1
+            for field, value in values.items():
+                totals[field] += value
+            self._emit(dict({'type': 'llm', 'name': stage, 'model': model}, **values))
+
+    def snapshot(self) -> Dict:
+        """Structured view of everything recorded so far"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {name: {'count': count, 'total_seconds': total, 'max_seconds': peak,
+                                  'mean_seconds': total / count if count else 0.0, 'errors': errors}
+                           for name, (count, total, peak, errors) in self.timings.items()},
+                'llm': {stage: dict(totals) for stage, totals in self.llm.items()},
+            }
+
+    def to_prometheus(self, prefix: str = 'mail_agent') -> str:
+        """Render the snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [f'# TYPE {prefix}_stage_seconds summary']
+        for name, stage in snapshot['stages'].items():
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage["total_seconds"]:.6f}')
+        lines.append(f'# TYPE {prefix}_stage_seconds_max gauge')
+        for name, stage in snapshot['stages'].items():
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {stage["max_seconds"]:.6f}')
+        lines.append(f'# TYPE {prefix}_stage_errors_total counter')
+        for name, stage in snapshot['stages'].items():
+            lines.append(f'{prefix}_stage_errors_total{{stage="{name}"}} {stage["errors"]}')
+        lines.append(f'# TYPE {prefix}_events_total counter')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        # Each family's samples must directly follow its own TYPE line
+        lines.append(f'# TYPE {prefix}_llm_calls_total counter')
+        for stage, totals in snapshot['llm'].items():
+            lines.append(f'{prefix}_llm_calls_total{{stage="{stage}"}} {totals["calls"]}')
+        lines.append(f'# TYPE {prefix}_llm_tokens_total counter')
+        for stage, totals in snapshot['llm'].items():
+            lines.append(f'{prefix}_llm_tokens_total{{stage="{stage}",kind="prompt"}} {totals["prompt_eval_count"]}')
+            lines.append(f'{prefix}_llm_tokens_total{{stage="{stage}",kind="eval"}} {totals["eval_count"]}')
+        lines.append(f'# TYPE {prefix}_llm_seconds_total counter')
+        for stage, totals in snapshot['llm'].items():
+            for phase in ('total', 'load', 'prompt_eval', 'eval'):
+                seconds = totals[f'{phase}_duration'] / 1e9
+                lines.append(f'{prefix}_llm_seconds_total{{stage="{stage}",phase="{phase}"}} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Write the Prometheus text atomically (e.g. for node_exporter's textfile collector)"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def report(self) -> str:
+        """Human-readable per-stage breakdown, slowest stages first"""
+        snapshot = self.snapshot()
+        lines = [f"{'stage':<24}{'count':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+        for name, stage in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['total_seconds']):
+            lines.append(f"{name:<24}{stage['count']:>8}{stage['total_seconds']:>10.2f}"
+                         f"{stage['mean_seconds'] * 1000:>10.1f}{stage['max_seconds'] * 1000:>10.1f}")
+        for stage, totals in snapshot['llm'].items():
+            lines.append(f"llm {stage}: {totals['calls']} calls, {totals['prompt_eval_count']} prompt tokens, "
+                         f"{totals['eval_count']} eval tokens, {totals['total_duration'] / 1e9:.1f}s in Ollama")
+        return '\n'.join(lines)
+
+    def _emit(self, event):
+        # Caller holds the lock
+        if self._jsonl is not None:
+            event['ts'] = time.time()
+            self._jsonl.write(json.dumps(event) + '\n')
+
+
+# Process-wide registry; set MAIL_AGENT_METRICS=1 (and optionally
+# MAIL_AGENT_METRICS_JSONL=path) to enable it without code changes
+metrics = Metrics(enabled=os.environ.get('MAIL_AGENT_METRICS') == '1',
+                  jsonl_path=os.environ.get('MAIL_AGENT_METRICS_JSONL'))
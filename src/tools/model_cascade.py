@@ -0,0 +1,130 @@
+from typing import Any, Callable, Optional, Tuple
+from tools.llm_engine import LLMEngine
+from tools.metrics import metrics
+from tools.structured_output import repair_prompt
+
+# Below this self-reported confidence a fast-tier answer is re-asked of the large model
+DEFAULT_ESCALATE_BELOW = 0.75
+
+CONFIDENCE_INSTRUCTION = """
+        Also include the key "confidence": a float between 0 and 1 saying how sure you are of this answer.
+        """
+
+
+def pop_confidence(result: dict) -> Tuple[dict, float]:
+    """Split the self-reported confidence off a parsed JSON answer; missing or malformed counts as 0"""
+    try:
+        confidence = float(result.pop('confidence', 0) or 0)
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return result, min(max(confidence, 0.0), 1.0)
+
+
+class ModelCascade:
+    """Ask a small fast model first and the large model only when the answer is doubtful
+
+    The fast tier answers in JSON with a "confidence" key. Answers that fail
+    to parse, fail validation or report a confidence below `escalate_below`
+    are sent to the large model. Without a fast model every request goes
+    straight to the large model.
+
+    The fast tier is recorded under "<stage>.fast" and the large model under
+    "<stage>", so calls and latencies are reported per tier. Counters
+    "<stage>.accepted" and "<stage>.escalated" show how often each tier decides.
+    """
+
+    def __init__(self, engine: LLMEngine, model: str, fast_model: Optional[str] = None,
+                 escalate_below: float = DEFAULT_ESCALATE_BELOW):
+        self.engine = engine
+        self.model = model
+        self.fast_model = fast_model
+        self.escalate_below = escalate_below
+
+    def fast_prompt(self, prompt: str, instructions: str = '') -> str:
+        return prompt + instructions + CONFIDENCE_INSTRUCTION
+
+    def ask_sync(self, prompt: str, stage: str, parse: Callable[[str], Any],
+                 fast_parse: Optional[Callable[[str], Tuple[Any, float]]] = None,
+                 fast_instructions: str = '', fast_format: Any = 'json', retries: int = 0, **kwargs) -> Any:
+        """Blocking cascade: returns parse() of the large model's answer unless the fast tier is sure
+
+        fast_parse turns the fast tier's text into (result, confidence) and
+        raises on invalid answers; by default parse() is used and the
+        confidence is taken from the parsed JSON object. fast_instructions is
+        appended to the fast tier's prompt only, which is constrained by
+        fast_format. When parse() rejects the large model's answer it is asked
+        again up to `retries` times, with the reasons in the prompt.
+        """
+        if self.fast_model:
+            try:
+                text = self.engine.chat_json_sync(self.fast_prompt(prompt, fast_instructions),
+                                                  model=self.fast_model, stage=f'{stage}.fast', format=fast_format)
+                accepted = self._accept(stage, text, parse, fast_parse)
+            except Exception as e:
+                accepted = self._rejected(stage, e)
+            if accepted is not None:
+                return accepted[0]
+        request = prompt
+        for attempt in range(retries + 1):
+            if 'format' in kwargs:
+                text = self.engine.chat_json_sync(request, model=self.model, stage=stage, **kwargs)
+            else:
+                text = self.engine.chat_sync(request, model=self.model, stage=stage, **kwargs)['message']['content']
+            try:
+                return parse(text.strip())
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                request = self._repair(prompt, text, e, stage)
+
+    async def ask(self, prompt: str, stage: str, parse: Callable[[str], Any],
+                  fast_parse: Optional[Callable[[str], Tuple[Any, float]]] = None,
+                  fast_instructions: str = '', fast_format: Any = 'json', retries: int = 0, **kwargs) -> Any:
+        """Async variant of ask_sync"""
+        if self.fast_model:
+            try:
+                text = await self.engine.chat_json(self.fast_prompt(prompt, fast_instructions),
+                                                   model=self.fast_model, stage=f'{stage}.fast', format=fast_format)
+                accepted = self._accept(stage, text, parse, fast_parse)
+            except Exception as e:
+                accepted = self._rejected(stage, e)
+            if accepted is not None:
+                return accepted[0]
+        request = prompt
+        for attempt in range(retries + 1):
+            if 'format' in kwargs:
+                text = await self.engine.chat_json(request, model=self.model, stage=stage, **kwargs)
+            else:
+                text = await self.engine.chat_text(request, model=self.model, stage=stage, **kwargs)
+            try:
+                return parse(text.strip())
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                request = self._repair(prompt, text, e, stage)
+
+    def _repair(self, prompt, text, error, stage):
+        metrics.incr(f'{stage}.repairs')
+        return repair_prompt(prompt, text, error)
+
+    def _accept(self, stage, text, parse, fast_parse):
+        """(result,) when the fast answer is good enough, None when it must be escalated"""
+        try:
+            result, confidence = fast_parse(text) if fast_parse else pop_confidence(parse(text))
+        except Exception:
+            metrics.incr(f'{stage}.escalated')
+            metrics.incr(f'{stage}.escalated_invalid')
+            return None
+        if confidence < self.escalate_below:
+            metrics.incr(f'{stage}.escalated')
+            metrics.incr(f'{stage}.escalated_low_confidence')
+            return None
+        metrics.incr(f'{stage}.accepted')
+        return (result,)
+
+    def _rejected(self, stage, error):
+        # A failing fast tier (e.g. the small model is not pulled) must not fail the request
+        print(f"Fast model {self.fast_model} failed, escalating: {error}")
+        metrics.incr(f'{stage}.escalated')
+        metrics.incr(f'{stage}.escalated_error')
+        return None
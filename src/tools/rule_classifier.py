@@ -0,0 +1,117 @@
+import re
+from email.utils import parseaddr
+
+# Gmail system labels that are reliable enough to classify on their own
+LABEL_RULES = {
+    'SPAM': ('Spam', 0.0, 0.99),
+    'CATEGORY_PROMOTIONS': ('Shopping', 0.1, 0.9),
+    'CATEGORY_SOCIAL': ('Social', 0.2, 0.85),
+    'CATEGORY_FORUMS': ('Social', 0.2, 0.8),
+}
+
+DOMAIN_RULES = {
+    'linkedin.com': 'Social',
+    'facebookmail.com': 'Social',
+    'x.com': 'Social',
+    'twitter.com': 'Social',
+    'paypal.com': 'Finance',
+    'amazon.com': 'Shopping',
+    'substack.com': 'News',
+    'medium.com': 'News',
+}
+
+# (category, importance_score, confidence, pattern over subject + sender)
+KEYWORD_RULES = [
+    ('Shopping', 0.2, 0.85, r'\b(order (confirmation|confirmed|shipped)|your order|has shipped|delivery update|tracking number)\b'),
+    ('Finance', 0.3, 0.8, r'\b(receipt|payment (received|confirmation)|your statement|e-?statement)\b'),
+    ('News', 0.1, 0.85, r'\b(newsletter|weekly digest|daily digest|this week in|top stories)\b'),
+    ('Shopping', 0.1, 0.8, r'(\d+% off|\bsale\b|\bdeals?\b|\bcoupon\b|limited time|free shipping)'),
+]
+
+# Anything that looks like it might need a person's attention always goes to the model
+ESCALATE_PATTERN = r'\b(urgent|asap|action required|deadline|due (date|by)|password|security alert|verify|overdue|invoice)\b'
+
+NOREPLY_PATTERN = r'^(no-?reply|do-?not-?reply|notifications?|newsletter|news|marketing|info)@'
+
+
+class RuleClassifier:
+    """Cheap first-tier classifier for obvious bulk mail
+
+    Produces the same schema as MailClassifier plus a confidence value; the
+    caller escalates to the LLM when the confidence is below its threshold.
+    """
+
+    def __init__(self, domain_rules=None, keyword_rules=None):
+        self.domain_rules = dict(DOMAIN_RULES, **(domain_rules or {}))
+        self.keyword_rules = [(category, importance, confidence, re.compile(pattern, re.IGNORECASE))
+                              for category, importance, confidence, pattern in (keyword_rules or KEYWORD_RULES)]
+        self.escalate_re = re.compile(ESCALATE_PATTERN, re.IGNORECASE)
+        self.noreply_re = re.compile(NOREPLY_PATTERN, re.IGNORECASE)
+        self.stats = {'checked': 0, 'hits': 0, 'escalated': 0}
+        self.rule_hits = {}
+
+    def classify(self, email_data):
+        """Return a classification with a 'confidence' field (0 means no rule matched)"""
+        self.stats['checked'] += 1
+        category, importance, confidence, rule = self._match(email_data)
+        return {
+            "category": category,
+            "importance_score": importance,
+            "requires_action": False,
+            "priority_level": "Low",
+            "suggested_action": None,
+            "deadline": None,
+            "confidence": confidence,
+            "classified_by": f"rules:{rule}" if rule else "rules"
+        }
+
+    def pre_classify(self, email_data, threshold=0.8):
+        """Return the rule result when confident enough, otherwise None to escalate"""
+        result = self.classify(email_data)
+        if result['confidence'] >= threshold:
+            self.stats['hits'] += 1
+            rule = result['classified_by']
+            self.rule_hits[rule] = self.rule_hits.get(rule, 0) + 1
+            return result
+        self.stats['escalated'] += 1
+        return None
+
+    def hit_rate(self):
+        return self.stats['hits'] / self.stats['checked'] if self.stats['checked'] else 0.0
+
+    def report(self):
+        return (f"Rule tier: {self.stats['hits']}/{self.stats['checked']} handled without the LLM "
+                f"({self.hit_rate():.0%}), {self.stats['escalated']} escalated")
+
+    def _match(self, email_data):
+        labels = email_data.get('labels', [])
+        if 'SPAM' in labels:
+            return LABEL_RULES['SPAM'] + ('label:SPAM',)
+
+        subject = email_data.get('subject', '')
+        address = parseaddr(email_data.get('sender', ''))[1].lower()
+        if self.escalate_re.search(subject):
+            return 'Uncategorized', 0.5, 0.0, None
+
+        bulk = bool(email_data.get('list_unsubscribe')) or email_data.get('precedence') in ('bulk', 'list', 'junk')
+        automated = bulk or bool(email_data.get('auto_submitted')) or bool(self.noreply_re.match(address))
+
+        for label in labels:
+            if label in LABEL_RULES:
+                category, importance, confidence = LABEL_RULES[label]
+                return category, importance, confidence, f'label:{label}'
+
+        text = f"{subject} {address}"
+        for category, importance, confidence, pattern in self.keyword_rules:
+            if pattern.search(text):
+                # Keyword matches on personal mail are weak evidence; bulk headers confirm them
+                return category, importance, confidence if automated else confidence - 0.3, f'keyword:{category}'
+
+        domain = address.rsplit('@', 1)[-1]
+        for rule_domain, category in self.domain_rules.items():
+            if domain == rule_domain or domain.endswith('.' + rule_domain):
+                return category, 0.2, 0.85 if automated else 0.5, f'domain:{rule_domain}'
+
+        if bulk:
+            return 'News', 0.1, 0.7, 'bulk'
+        return 'Uncategorized', 0.5, 0.0, None
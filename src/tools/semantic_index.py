@@ -0,0 +1,294 @@
+import sqlite3
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+from tools.classification_cache import content_hash
+from tools.llm_engine import LLMEngine
+from tools.metrics import metrics
+from tools.body_text import prompt_text
+
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+# Bump whenever embedding_text changes so cached vectors are recomputed
+EMBED_VERSION = "2"
+EMBED_BATCH_SIZE = 64
+# Cosine similarity above which two emails are treated as the same mail
+DUPLICATE_THRESHOLD = 0.95
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    message_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (message_id, model)
+);
+"""
+
+
+def embedding_text(email_data: Dict) -> str:
+    """Text embedded for an email: subject, sender and the preprocessed body"""
+    return f"{email_data.get('subject', '')}\n{email_data.get('sender', '')}\n{prompt_text(email_data)}"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class EmbeddingCache:
+    """Per-message embedding vectors persisted in SQLite as float32 blobs
+
+    Entries are keyed on message_id and model, and store the content hash they
+    were computed from, so an edited message is recomputed rather than reused.
+    """
+
+    def __init__(self, db_path: str = 'mail_store.db'):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def get_many(self, model: str, keys: Iterable[Tuple[str, str]]) -> Dict[str, np.ndarray]:
+        """Look up (message_id, content_hash) pairs; returns {message_id: vector} for the hits"""
+        keys = dict(keys)
+        message_ids = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for message_id, key, blob in self.conn.execute(
+                        f'SELECT message_id, content_hash, vector FROM embeddings '
+                        f'WHERE model = ? AND message_id IN ({placeholders})', [model] + chunk):
+                    if keys[message_id] == key:
+                        found[message_id] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, entries: Iterable[Tuple[str, str, np.ndarray]]):
+        """Store (message_id, content_hash, vector) tuples"""
+        rows = [(mid, model, key, np.asarray(vector, dtype=np.float32).tobytes()) for mid, key, vector in entries]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (message_id, model, content_hash, vector) VALUES (?, ?, ?, ?)',
+                rows)
+
+    def load_all(self, model: str) -> Tuple[List[str], Optional[np.ndarray]]:
+        """Every cached vector for a model, as (message_ids, matrix)"""
+        with self._lock:
+            rows = self.conn.execute('SELECT message_id, vector FROM embeddings WHERE model = ?',
+                                     (model,)).fetchall()
+        if not rows:
+            return [], None
+        return [row[0] for row in rows], np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+
+    def delete(self, message_ids: Iterable[str]):
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM embeddings WHERE message_id = ?', [(mid,) for mid in message_ids])
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+
+class VectorIndex:
+    """In-memory cosine-similarity index over unit-normalized float32 vectors
+
+    Searches are one matrix product per batch of queries, so k-nearest lookups
+    for many queries cost little more than for one.
+    """
+
+    def __init__(self, dim: Optional[int] = None):
+        self.ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._matrix = np.zeros((0, dim or 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, message_id):
+        return message_id in self._positions
+
+    def add(self, ids: List[str], vectors):
+        """Add or replace vectors for the given IDs"""
+        if not ids:
+            return
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        if not len(self.ids):
+            self._matrix = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        fresh_ids, fresh_rows = [], []
+        for message_id, vector in zip(ids, vectors):
+            position = self._positions.get(message_id)
+            if position is None:
+                self._positions[message_id] = len(self.ids) + len(fresh_ids)
+                fresh_ids.append(message_id)
+                fresh_rows.append(vector)
+            else:
+                self._matrix[position] = vector
+        if fresh_ids:
+            self.ids.extend(fresh_ids)
+            self._matrix = np.vstack([self._matrix, np.stack(fresh_rows)])
+
+    def remove(self, ids: Iterable[str]):
+        drop = {self._positions[mid] for mid in ids if mid in self._positions}
+        if not drop:
+            return
+        keep = [i for i in range(len(self.ids)) if i not in drop]
+        self.ids = [self.ids[i] for i in keep]
+        self._matrix = self._matrix[keep]
+        self._positions = {mid: i for i, mid in enumerate(self.ids)}
+
+    def search(self, queries, k: int = 10, allowed: Optional[set] = None) -> List[List[Tuple[str, float]]]:
+        """Top-k (message_id, cosine) per query vector, best first
+
+        allowed restricts results to a subset of IDs (e.g. a date window).
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if not len(self.ids):
+            return [[] for _ in queries]
+        scores = queries @ self._matrix.T
+        if allowed is not None:
+            mask = np.fromiter((mid in allowed for mid in self.ids), dtype=bool, count=len(self.ids))
+            scores[:, ~mask] = -np.inf
+        k = min(k, len(self.ids))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-row[candidates])]
+            results.append([(self.ids[i], float(row[i])) for i in ordered if np.isfinite(row[i])])
+        return results
+
+
+def cluster_near_duplicates(ids: List[str], vectors, threshold: float = DUPLICATE_THRESHOLD,
+                            block_size: int = 1024) -> List[List[str]]:
+    """Group IDs whose vectors are within `threshold` cosine similarity of a cluster leader
+
+    Greedy leader clustering in input order: each email joins the most similar
+    earlier leader at or above the threshold, otherwise it becomes a leader. Similarities
+    are computed block by block against the leaders matrix. The leader is the
+    first ID of each returned cluster.
+    """
+    if not ids:
+        return []
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+    clusters: List[List[str]] = []
+    leaders = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    for start in range(0, len(ids), block_size):
+        block = vectors[start:start + block_size]
+        scores = block @ leaders.T if len(leaders) else None
+        new_leaders = []
+        for offset, vector in enumerate(block):
+            message_id = ids[start + offset]
+            best, best_score = -1, threshold
+            if scores is not None and scores.shape[1]:
+                candidate = int(np.argmax(scores[offset]))
+                if scores[offset, candidate] >= best_score:
+                    best, best_score = candidate, scores[offset, candidate]
+            # Leaders created earlier in this block are not in `scores` yet
+            for j, leader in enumerate(new_leaders):
+                score = float(vector @ leader)
+                if score >= best_score:
+                    best, best_score = len(leaders) + j, score
+            if best >= 0:
+                clusters[best].append(message_id)
+            else:
+                new_leaders.append(vector)
+                clusters.append([message_id])
+        if new_leaders:
+            leaders = np.vstack([leaders, np.stack(new_leaders)])
+    return clusters
+
+
+class SemanticIndex:
+    """Embeds emails through Ollama, caches the vectors and serves similarity queries
+
+    Vectors are computed in batches only for messages whose content hash is not
+    cached yet. The in-memory VectorIndex is loaded lazily from the cache.
+    """
+
+    def __init__(self, db_path: str = 'mail_store.db', engine: Optional[LLMEngine] = None,
+                 model: str = DEFAULT_EMBED_MODEL, batch_size: int = EMBED_BATCH_SIZE):
+        self.model = model
+        self.engine = engine or LLMEngine()
+        self.batch_size = batch_size
+        self.cache = EmbeddingCache(db_path)
+        self._index = None
+
+    @property
+    def index(self) -> VectorIndex:
+        if self._index is None:
+            self._index = VectorIndex()
+            with metrics.span('cache.load'):
+                ids, matrix = self.cache.load_all(self.model)
+            self._index.add(ids, matrix)
+        return self._index
+
+    def embed_emails(self, emails: List[Dict]) -> Dict[str, np.ndarray]:
+        """Vectors for the emails, keyed by message_id, computing only cache misses"""
+        vectors, missing = self._cached(emails)
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            embedded = self.engine.embed_sync([embedding_text(email) for email, _ in batch], model=self.model)
+            self._store(batch, embedded, vectors)
+        return vectors
+
+    async def embed_emails_async(self, emails: List[Dict]) -> Dict[str, np.ndarray]:
+        """Async variant of embed_emails; batches are sent concurrently"""
+        vectors, missing = self._cached(emails)
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+
+        async def embed(batch):
+            return await self.engine.embed([embedding_text(email) for email, _ in batch], model=self.model)
+
+        for batch, embedded in zip(batches, await self.engine.map(embed, batches)):
+            self._store(batch, embedded, vectors)
+        return vectors
+
+    def clusters(self, emails: List[Dict], vectors: Dict[str, np.ndarray],
+                 threshold: float = DUPLICATE_THRESHOLD) -> List[List[Dict]]:
+        """Near-duplicate clusters among the emails; singletons are included"""
+        by_id = {email['message_id']: email for email in emails if email['message_id'] in vectors}
+        ids = list(by_id)
+        groups = cluster_near_duplicates(ids, [vectors[mid] for mid in ids], threshold) if ids else []
+        return [[by_id[mid] for mid in group] for group in groups]
+
+    def search(self, query: str, k: int = 10, allowed: Optional[set] = None) -> List[Tuple[str, float]]:
+        """Top-k stored message IDs for a free-text query, with cosine scores"""
+        vector = self.engine.embed_sync([query], model=self.model, stage='embed_query')[0]
+        with metrics.span('semantic.search'):
+            return self.index.search([vector], k=k, allowed=allowed)[0]
+
+    async def search_async(self, query: str, k: int = 10, allowed: Optional[set] = None) -> List[Tuple[str, float]]:
+        """Async variant of search"""
+        vector = (await self.engine.embed([query], model=self.model, stage='embed_query'))[0]
+        with metrics.span('semantic.search'):
+            return self.index.search([vector], k=k, allowed=allowed)[0]
+
+    def forget(self, message_ids: Iterable[str]):
+        """Drop the vectors of deleted messages from the cache and the loaded index"""
+        message_ids = list(message_ids)
+        self.cache.delete(message_ids)
+        if self._index is not None:
+            self._index.remove(message_ids)
+
+    def _cached(self, emails):
+        keys = {email['message_id']: content_hash(email, self.model, EMBED_VERSION) for email in emails}
+        with metrics.span('cache.load'):
+            vectors = self.cache.get_many(self.model, keys.items())
+        missing = [(email, keys[email['message_id']]) for email in emails if email['message_id'] not in vectors]
+        metrics.incr('embed.cache_hits', len(vectors))
+        metrics.incr('embed.cache_misses', len(missing))
+        return vectors, missing
+
+    def _store(self, batch, embedded, vectors):
+        arrays = [np.asarray(vector, dtype=np.float32) for vector in embedded]
+        with metrics.span('cache.save'):
+            self.cache.put_many(self.model, [(email['message_id'], key, vector)
+                                             for (email, key), vector in zip(batch, arrays)])
+        for (email, _), vector in zip(batch, arrays):
+            vectors[email['message_id']] = vector
+        if self._index is not None:
+            self._index.add([email['message_id'] for email, _ in batch], arrays)
@@ -0,0 +1,182 @@
+import json
+import re
+from typing import Dict, List, Optional
+
+THINK_RE = re.compile(r'<think>.*?(</think>|$)', re.DOTALL)
+NULL_STRINGS = {'', 'null', 'none', 'n/a', 'na', 'no', 'nil'}
+TRUE_STRINGS = {'true', 'yes', 'y', '1'}
+FALSE_STRINGS = {'false', 'no', 'n', '0'}
+
+
+class SchemaError(ValueError):
+    """A model answer that could not be parsed or coerced into the schema
+
+    problems lists one human-readable line per offending field; it is fed back
+    to the model on a retry.
+    """
+
+    def __init__(self, problems: List[str]):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+class JsonObjectScanner:
+    """Incrementally finds the end of the first top-level JSON object in streamed text
+
+    feed() returns the complete object text as soon as its closing brace
+    arrives, so generation can be stopped right there instead of waiting for
+    trailing chatter. Text before the opening brace (e.g. reasoning or a code
+    fence) is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.in_think = False
+        self._pending = ''
+
+    def feed(self, chunk: str) -> Optional[str]:
+        for char in chunk:
+            if not self.started:
+                if self._skip_think(char):
+                    continue
+                if char != '{':
+                    continue
+                self.started = True
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    return ''.join(self.buffer)
+        return None
+
+    def _skip_think(self, char: str) -> bool:
+        # Reasoning models wrap their chain of thought in <think>...</think>, which may contain braces
+        self._pending = (self._pending + char)[-8:]
+        if self._pending.endswith('<think>'):
+            self.in_think = True
+        elif self._pending.endswith('</think>'):
+            self.in_think = False
+        return self.in_think
+
+
+def extract_json_object(text: str) -> Dict:
+    """First JSON object in a model answer, ignoring <think> blocks, code fences and trailing text"""
+    text = THINK_RE.sub('', text)
+    object_text = JsonObjectScanner().feed(text)
+    if object_text is None:
+        raise SchemaError(["the answer contains no complete JSON object"])
+    try:
+        value = json.loads(object_text)
+    except json.JSONDecodeError:
+        # Trailing commas are the most common slip of small models
+        try:
+            value = json.loads(re.sub(r',\s*([}\]])', r'\1', object_text))
+        except json.JSONDecodeError as e:
+            raise SchemaError([f"the JSON object does not parse: {e.msg}"])
+    return value
+
+
+def with_properties(schema: Dict, **properties) -> Dict:
+    """Copy of an object schema with extra required properties"""
+    return dict(schema, properties=dict(schema['properties'], **properties),
+                required=list(schema['required']) + list(properties))
+
+
+def coerce(value, schema: Dict, name: str = 'value'):
+    """Coerce one value into the JSON schema type, raising SchemaError when it cannot be"""
+    types = schema.get('type', 'string')
+    types = types if isinstance(types, list) else [types]
+    if 'null' in types and (value is None or (isinstance(value, str) and value.strip().lower() in NULL_STRINGS)):
+        return None
+    if 'boolean' in types:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)) and value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in TRUE_STRINGS | FALSE_STRINGS:
+            return value.strip().lower() in TRUE_STRINGS
+        raise SchemaError([f"{name} must be true or false, got {value!r}"])
+    if 'number' in types:
+        try:
+            if isinstance(value, str):
+                text = value.strip()
+                number = float(text.rstrip('%')) / (100 if text.endswith('%') else 1)
+            elif isinstance(value, bool):
+                raise TypeError
+            else:
+                number = float(value)
+        except (TypeError, ValueError):
+            raise SchemaError([f"{name} must be a number, got {value!r}"])
+        if number < schema.get('minimum', number) or number > schema.get('maximum', number):
+            raise SchemaError([f"{name} must be between {schema.get('minimum')} and {schema.get('maximum')}, "
+                               f"got {number}"])
+        return number
+    if value is None or isinstance(value, (dict, list)):
+        raise SchemaError([f"{name} must be a string, got {value!r}"])
+    text = str(value).strip()
+    if 'enum' in schema:
+        for option in schema['enum']:
+            if text.lower() == option.lower():
+                return option
+        raise SchemaError([f"{name} must be one of {', '.join(schema['enum'])}, got {value!r}"])
+    return text
+
+
+def coerce_object(value, schema: Dict) -> Dict:
+    """Coerce a parsed object into the schema's properties, dropping unknown keys
+
+    Missing nullable properties become None; every other problem is
+    collected so a retry can name all of them at once.
+    """
+    if not isinstance(value, dict):
+        raise SchemaError(["the answer must be a JSON object"])
+    result, problems = {}, []
+    for name, prop in schema['properties'].items():
+        if name not in value:
+            if 'null' in (prop.get('type') if isinstance(prop.get('type'), list) else [prop.get('type')]):
+                result[name] = None
+            elif name in schema.get('required', ()):
+                problems.append(f"{name} is missing")
+            continue
+        try:
+            result[name] = coerce(value[name], prop, name)
+        except SchemaError as e:
+            problems.extend(e.problems)
+    if problems:
+        raise SchemaError(problems)
+    return result
+
+
+def parse_structured(text: str, schema: Dict) -> Dict:
+    """Extract, coerce and validate a model answer against an object schema"""
+    return coerce_object(extract_json_object(text), schema)
+
+
+def repair_prompt(prompt: str, answer: str, error: Exception) -> str:
+    """Re-ask for an answer that failed validation, naming exactly what was wrong"""
+    problems = error.problems if isinstance(error, SchemaError) else [str(error)]
+    issues = '\n'.join(f"        - {problem}" for problem in problems)
+    return f"""{prompt}
+        Your previous answer was:
+        {answer.strip()[:2000]}
+
+        It was rejected because:
+{issues}
+
+        Reply with only the corrected JSON object.
+        """
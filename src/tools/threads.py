@@ -0,0 +1,78 @@
+import re
+from datetime import datetime
+from typing import Dict, List
+from tools.body_text import estimate_tokens, prompt_text
+
+# Thread prompts carry only the new text of each message; long threads are
+# processed in several rolling steps so one prompt never exceeds the budget
+MESSAGE_TOKENS = 375
+PROMPT_TOKENS = 1500
+
+SUBJECT_PREFIX_PATTERN = re.compile(r'^\s*((re|fw|fwd|aw|sv|wg)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+
+def render_messages(messages: List[Dict]) -> str:
+    """Numbered sender/date headers with the new text of each message, for thread prompts"""
+    return '\n\n'.join(
+        f"[{i}] From: {email['sender']} | Date: {email.get('date') or 'unknown'}\n"
+        f"{prompt_text(email, MESSAGE_TOKENS)}"
+        for i, email in enumerate(messages, 1))
+
+
+def chunk_messages(messages: List[Dict]) -> List[List[Dict]]:
+    """Split a thread's messages into consecutive groups that fit one prompt"""
+    chunks, current, used = [], [], 0
+    for email in messages:
+        size = estimate_tokens(prompt_text(email, MESSAGE_TOKENS))
+        if current and used + size > PROMPT_TOKENS:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(email)
+        used += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def normalize_subject(subject: str) -> str:
+    """Subject without Re:/Fwd: prefixes, used to title a thread"""
+    return SUBJECT_PREFIX_PATTERN.sub('', subject or '').strip()
+
+
+def thread_key(email: Dict) -> str:
+    # Emails stored before thread IDs were kept form a thread of their own
+    return email.get('thread_id') or email['message_id']
+
+
+def message_timestamp(email: Dict) -> float:
+    date = email.get('date')
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date)
+    return date.timestamp() if date else 0.0
+
+
+def group_by_thread(emails: List[Dict]) -> Dict[str, List[Dict]]:
+    """Group emails by thread, oldest message first; threads ordered by their latest message, newest first"""
+    threads = {}
+    for email in emails:
+        threads.setdefault(thread_key(email), []).append(email)
+    for messages in threads.values():
+        messages.sort(key=message_timestamp)
+    return dict(sorted(threads.items(), key=lambda item: -message_timestamp(item[1][-1])))
+
+
+def participants(messages: List[Dict]) -> List[str]:
+    """Distinct senders of a thread in order of first appearance"""
+    return list(dict.fromkeys(email['sender'] for email in messages if email.get('sender')))
+
+
+def thread_representative(messages: List[Dict]) -> Dict:
+    """A single digest entry for a thread: its latest message, carrying the thread's subject, senders and summary"""
+    latest = messages[-1]
+    entry = latest.copy()
+    if len(messages) > 1:
+        entry['subject'] = f"{normalize_subject(latest['subject'])} ({len(messages)} messages)"
+        entry['sender'] = ', '.join(participants(messages))
+    if latest.get('thread_summary'):
+        entry['summary'] = latest['thread_summary']
+    return entry